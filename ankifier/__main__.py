@@ -0,0 +1,202 @@
+import cProfile
+import contextlib
+import logging
+import time
+
+import click
+import yaml
+
+from ankifier import utils
+
+
+@contextlib.contextmanager
+def profiling(path: str, profiler: str):
+    # Profile everything run inside the block, saving the results to path
+    if path is None:
+        yield
+        return
+
+    if profiler == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise click.UsageError("pyinstrument isn't installed")
+
+        profile = Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            with open(path, "w") as f:
+                f.write(profile.output_html())
+    else:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(path)
+
+
+@click.command()
+@click.option("--settings", type=click.Path(exists=True), required=True)
+@click.option("--language", required=True, help="Language from the settings file")
+@click.option(
+    "--vocab",
+    type=click.Path(exists=True),
+    required=True,
+    help="Vocab file, one entry (or 'phrase | translation') per line",
+)
+@click.option("--output-dir", type=click.Path(file_okay=False), default=".")
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["csv", "jsonl"]),
+    default="csv",
+    help="Format of the output files",
+)
+@click.option("--chunk-size", default=1000, help="Rows to generate cards for at once")
+@click.option("--push", is_flag=True, help="Write the cards straight to Anki")
+@click.option("--test-mode", is_flag=True, help="Don't send anything to DeepL")
+@click.option(
+    "--metrics-out",
+    type=click.Path(dir_okay=False),
+    help="Save counts and timings for each stage and external call to this file",
+)
+@click.option(
+    "--metrics-format", type=click.Choice(["json", "prometheus"]), default="json"
+)
+@click.option(
+    "--profile",
+    type=click.Path(dir_okay=False),
+    help="Profile the run and save the results to this file",
+)
+@click.option(
+    "--profiler",
+    type=click.Choice(["cprofile", "pyinstrument"]),
+    default="cprofile",
+    help="cprofile saves pstats data, pyinstrument (if installed) an HTML report",
+)
+@click.option(
+    "--job-store",
+    type=click.Path(dir_okay=False),
+    help="Record progress in this file, so a run that fails can carry on where it "
+    + "left off (defaults to job_store_path from the settings)",
+)
+@click.option("--restart", is_flag=True, help="Ignore earlier runs of the same job")
+@click.option("--verbose", is_flag=True)
+def main(
+    settings: click.Path,
+    language: str,
+    vocab: click.Path,
+    output_dir: click.Path,
+    output_format: str,
+    chunk_size: int,
+    push: bool,
+    test_mode: bool,
+    metrics_out: click.Path,
+    metrics_format: str,
+    profile: click.Path,
+    profiler: str,
+    job_store: click.Path,
+    restart: bool,
+    verbose: bool,
+):
+    # Generate cards from a vocab file without the Streamlit app. pandas is
+    # imported here rather than at the top so --help doesn't wait for it.
+    import pandas as pd
+
+    logging.basicConfig(level=logging.INFO if verbose else logging.WARNING)
+
+    with open(settings) as f:
+        config = yaml.safe_load(f)
+    language_settings = config["language_configs"][language]
+
+    started = time.perf_counter()
+    context = utils.context_from_settings(config, language, test_mode)
+    anki_index = utils.AnkiIndex(context.anki_deck)
+    click.echo(f"Loaded settings in {time.perf_counter() - started:.1f}s", err=True)
+
+    audio_cache = None
+    if push and config["ankifier_config"].get("audio_cache_dir"):
+        audio_cache = utils.AudioCache(config["ankifier_config"]["audio_cache_dir"])
+
+    job = None
+    job_store = job_store or config["ankifier_config"].get("job_store_path")
+    if job_store:
+        jobs = utils.JobStore(job_store)
+        with open(vocab, "rb") as f:
+            job_id = utils.job_id(f.read(), context, language_settings["spacy_model"])
+        if restart:
+            jobs.clear(job_id)
+        job = jobs.job(job_id)
+        counts = job.counts()
+        if counts:
+            click.echo(
+                f"Carrying on from an earlier run: {counts.get('done', 0)} rows "
+                + f"done, {counts.get('failed', 0)} to retry",
+                err=True,
+            )
+
+    count_errors = 0
+    started = time.perf_counter()
+
+    utils.metrics.enabled = metrics_out is not None
+
+    with (
+        profiling(profile, profiler),
+        utils.OutputFiles(output_dir, output_format) as out,
+    ):
+        chunks = utils.read_vocab(vocab, chunk_size)
+        for result in utils.stream_cards(chunks, context, anki_index, job):
+            out.write(result)
+
+            if push and result.cards:
+                errors = utils.write_df_to_anki(
+                    pd.DataFrame(result.cards, columns=utils.CARD_COLUMNS),
+                    context.anki_deck,
+                    language_settings["card_type"],
+                    anki_index,
+                    config["ankifier_config"].get(
+                        "anki_batch_size", utils.ANKI_WRITE_BATCH_SIZE
+                    ),
+                    audio_cache=audio_cache,
+                    job=job,
+                )
+                for base, error in errors:
+                    click.echo(f"Error writing {base}: {error}", err=True)
+                count_errors += len(errors)
+
+            elapsed = time.perf_counter() - started
+            click.echo(
+                f"{out.counts['rows']} rows, {out.counts['cards']} cards "
+                + f"({out.counts['rows'] / elapsed:.1f} rows/s)",
+                err=True,
+            )
+
+    if job is not None and push:
+        job.finish_writing()
+
+    counts = out.counts
+    elapsed = time.perf_counter() - started
+    click.echo(
+        f"Generated {counts['cards']} cards and {counts['additional']} additional "
+        + f"outputs from {counts['rows']} rows in {elapsed:.1f}s "
+        + f"({counts['rows'] / elapsed if elapsed else 0:.1f} rows/s). "
+        + f"{counts['generated_nothing']} entries did not generate any cards."
+    )
+    if push:
+        click.echo(f"Wrote {counts['cards'] - count_errors} cards to Anki")
+
+    if metrics_out:
+        with open(metrics_out, "w") as f:
+            if metrics_format == "prometheus":
+                f.write(utils.metrics.to_prometheus())
+            else:
+                f.write(utils.metrics.to_json())
+
+
+if __name__ == "__main__":
+    main()
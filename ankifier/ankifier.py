@@ -1,14 +1,197 @@
-import deepl
-import pandas as pd
-import spacy
+import os
+import tempfile
+from functools import partial
+
 import streamlit as st
 import utils
 import yaml
-from pymongo import MongoClient
-from pymongo.errors import ServerSelectionTimeoutError
 
 st.set_page_config(page_title="Ankifier")
 
+# pandas, SpaCy, DeepL and pymongo are imported where they're first needed, so
+# the page shows up without waiting for all of them to load
+
+# Vocab files longer than this are shown a page at a time and streamed through
+# card generation, rather than loaded into an editable table
+EDITABLE_ROWS = 2000
+PAGE_SIZE = 100
+
+# Seconds to keep what we've read from Mongo, so a re-imported or re-indexed
+# collection gets picked up without restarting the app
+MONGO_CACHE_TTL = 300
+
+
+def show_pages(read_page, total_rows, key):
+    # Show a table that's too big to load at once a page at a time
+    pages = max(1, -(-total_rows // PAGE_SIZE))
+    page = st.number_input(
+        f"Page (of {pages})", min_value=1, max_value=pages, value=1, key=key
+    )
+    st.dataframe(
+        read_page(page - 1, PAGE_SIZE), hide_index=True, use_container_width=True
+    )
+
+
+def show_metrics():
+    # Where the time went during the last generation, if metrics are turned on
+    if utils.metrics.enabled:
+        import pandas as pd
+
+        with st.expander("Timings"):
+            st.dataframe(
+                pd.DataFrame(utils.metrics.summary()),
+                hide_index=True,
+                use_container_width=True,
+            )
+            st.json(utils.metrics.counters)
+
+
+# Streamlit reruns this whole script on every interaction, so anything slow to
+# load or connect to is cached across reruns. Resources are shared as they are,
+# data is copied out of the cache each time.
+@st.cache_data
+def load_settings(contents: bytes) -> dict:
+    return yaml.safe_load(contents)
+
+
+@st.cache_data
+def load_language_config(path: str, modified: float) -> dict:
+    # Keyed on the modification time too, so edits to the file get picked up
+    with open(path) as f:
+        return yaml.safe_load(f)
+
+
+@st.cache_resource
+def load_spacy(spacy_model: str):
+    import spacy
+
+    return spacy.load(spacy_model)
+
+
+@st.cache_resource
+def connect_to_mongo():
+    from pymongo import MongoClient
+
+    return MongoClient(serverSelectionTimeoutMS=1000)
+
+
+@st.cache_data(ttl=MONGO_CACHE_TTL)
+def has_word_index(_coll, full_name: str) -> bool:
+    return utils.uses_word_index(_coll)
+
+
+@st.cache_resource
+def load_translator(api_key: str):
+    import deepl
+
+    return deepl.Translator(api_key)
+
+
+@st.cache_resource
+def open_generation_cache(
+    path, language, language_config, spacy_model, collection, forms_collection
+):
+    return utils.GenerationCache(
+        path, language, language_config, spacy_model, collection, forms_collection
+    )
+
+
+@st.cache_resource
+def open_translation_memory(path: str):
+    return utils.TranslationMemory(path)
+
+
+@st.cache_resource
+def open_audio_cache(cache_dir: str):
+    return utils.AudioCache(cache_dir)
+
+
+@st.cache_resource
+def open_job_store(path: str):
+    return utils.JobStore(path)
+
+
+class CachedLoaders(utils.SettingsLoaders):
+    # Loads the parts of the generation context through the caches above
+    def language_config(self, path: str) -> dict:
+        language_config = load_language_config(path, os.path.getmtime(path))
+        # Compile the jq filters up front rather than on the first import,
+        # once per session rather than on every rerun
+        if st.session_state.get("jq_cache_warmed_for") != language_config:
+            utils.jq_cache.warm(language_config)
+            st.session_state["jq_cache_warmed_for"] = language_config
+        return language_config
+
+    def spacy(self, spacy_model: str):
+        return load_spacy(spacy_model)
+
+    def mongo_client(self):
+        return connect_to_mongo()
+
+    def translator(self, api_key: str):
+        return load_translator(api_key)
+
+    def generation_cache(
+        self, path, language, language_config, spacy_model, collection, forms_collection
+    ):
+        return open_generation_cache(
+            path, language, language_config, spacy_model, collection, forms_collection
+        )
+
+    def translation_memory(self, path: str):
+        return open_translation_memory(path)
+
+
+def start_job(source: bytes, restart: bool = False):
+    # The import job for this vocab, if imports are being recorded, saying so
+    # if it's carrying on from an earlier run
+    jobs = st.session_state.get("job_store")
+    if jobs is None:
+        return None
+    config = st.session_state["config"]
+    job_id = utils.job_id(
+        source,
+        st.session_state["context"],
+        config["language_configs"][st.session_state["language"]]["spacy_model"],
+    )
+    if restart:
+        jobs.clear(job_id)
+    job = jobs.job(job_id)
+    counts = job.counts()
+    if counts:
+        st.info(
+            f"Carrying on from an earlier run: {counts.get('done', 0)} entries "
+            + f"already done, {counts.get('failed', 0)} to retry"
+        )
+    return job
+
+
+@st.cache_data(ttl=MONGO_CACHE_TTL, max_entries=1000)
+def look_up(
+    _coll, full_name: str, word: str, _forms_coll=None, forms_name: str = None
+) -> list:
+    entries = list(utils.look_up_word(_coll, word))
+    if not entries and _forms_coll is not None:
+        # Might be an inflected form, so show the entries for its headwords
+        entries_by_word = {word: []}
+        utils.fill_in_from_forms(_forms_coll, _coll, entries_by_word)
+        entries = entries_by_word[word]
+    return entries
+
+
+def read_upload_page(upload, page, page_size):
+    upload.seek(0)
+    return utils.read_vocab_page(upload, page, page_size)
+
+
+def clear_output_dir():
+    # Streamed imports save their outputs to a temporary directory, which only
+    # needs to last until the next import
+    output_dir = st.session_state.pop("output_dir", None)
+    if output_dir is not None:
+        output_dir.cleanup()
+
+
 test_mode = st.toggle("Testing mode", value=True)
 
 settings, import_cards, edit_cards, related_cards, look_up_cards = st.tabs(
@@ -21,8 +204,9 @@ with settings:
     )
 
     if uploaded:
-        config = yaml.safe_load(uploaded)
+        config = load_settings(uploaded.getvalue())
         st.session_state["config"] = config
+        utils.metrics.enabled = config["ankifier_config"].get("metrics", False)
 
         languages = config["language_configs"].keys()
         language = st.selectbox("Choose language", languages)
@@ -34,39 +218,64 @@ with settings:
             language
         ]["card_type"]
 
-        # Set up global configs
-        # Retrieve language-level config
-        with open(config["language_configs"][language]["word_settings"]) as f:
-            language_config = yaml.safe_load(f)
-        st.session_state["language_config"] = language_config
+        # Index of the base forms already in the deck, loaded when we generate
+        anki_deck = st.session_state["language_anki_deck"]
+        anki_index = st.session_state.get("anki_index")
+        if anki_index is None or anki_index.deck != anki_deck:
+            st.session_state["anki_index"] = utils.AnkiIndex(anki_deck)
 
-        # SpaCy
-        spacy_model = config["language_configs"][language]["spacy_model"]
-        st.session_state["nlp"] = spacy.load(spacy_model)
+        # Everything card generation needs, set up the same way as on the
+        # command line but through the caches above
+        context = utils.context_from_settings(
+            config, language, test_mode, CachedLoaders()
+        )
+        st.session_state["context"] = context
+
+        # Optional local copies of card audio, sent to Anki when writing cards
+        audio_cache_dir = config["ankifier_config"].get("audio_cache_dir")
+        if audio_cache_dir:
+            st.session_state["audio_cache"] = open_audio_cache(audio_cache_dir)
+        else:
+            st.session_state["audio_cache"] = None
+
+        # Optional record of imports, so failed ones can carry on where they
+        # left off
+        job_store_path = config["ankifier_config"].get("job_store_path")
+        if job_store_path:
+            st.session_state["job_store"] = open_job_store(job_store_path)
+        else:
+            st.session_state["job_store"] = None
+
+        from pymongo.errors import ServerSelectionTimeoutError
 
-        # Mongo
-        mongo_client = MongoClient(serverSelectionTimeoutMS=1000)
         try:
-            _ = mongo_client.is_mongos
+            _ = context.coll.database.client.is_mongos
         except ServerSelectionTimeoutError:
             st.warning("Can't connect to Mongo client. Is it running?")
-
-        st.session_state["mongo_coll"] = mongo_client[
-            config["ankifier_config"]["mongodb_name"]
-        ][config["language_configs"][language]["wiktionary_collection"]]
-
-        # Translator
-        if test_mode:
-            st.session_state["translator"] = utils.TestTranslator()
         else:
-            st.session_state["translator"] = deepl.Translator(
-                config["ankifier_config"]["deepl_api_key"]
-            )
+            if not has_word_index(context.coll, context.coll.full_name):
+                st.warning(
+                    "Wiktionary collection has no index on `word`, so lookups will "
+                    + "be slow. Run `data/create_indexes.py` to add one."
+                )
 
 with import_cards:
     data = st.file_uploader("Upload a vocab file:", type=["csv", "txt"])
 
     if data:
+        total_rows = utils.count_lines(data)
+        st.write(f"Found {total_rows} entries")
+
+    restart = False
+    if data and st.session_state.get("job_store") is not None:
+        restart = st.checkbox(
+            "Start over",
+            help="Ignore any earlier run of this import that failed part way",
+        )
+
+    if data and total_rows <= EDITABLE_ROWS:
+        import pandas as pd
+
         data_df = pd.read_csv(
             data, sep="|", header=None, names=["Word", "Translation"], dtype=str
         )
@@ -74,8 +283,6 @@ with import_cards:
         # Force coercion to str
         data_df["Translation"] = data_df["Translation"].fillna("")
 
-        st.write(f"Found {data_df.shape[0]} entries")
-
         edited_df = st.data_editor(
             data_df, hide_index=True, num_rows="dynamic", use_container_width=True
         )
@@ -84,30 +291,23 @@ with import_cards:
 
         if clicked:
             with st.spinner("Translating"):
+                utils.metrics.reset()
+                job = start_job(edited_df.to_csv(index=False).encode(), restart)
                 bar = st.progress(0)
                 cards, additional, generated_nothing = utils.parse_df_to_cards(
-                    edited_df.drop_duplicates(ignore_index=True), bar
+                    edited_df, bar, st.session_state["anki_index"], job
                 )
                 bar.empty()
+                st.session_state["import_job"] = job
+
+                st.session_state["generated_cards"] = cards
+                st.session_state["additional_outputs"] = additional
+                st.session_state["generated_nothing"] = generated_nothing
+                st.session_state.pop("generated_files", None)
+                clear_output_dir()
 
-                st.session_state["generated_cards"] = pd.DataFrame(
-                    cards,
-                    columns=[
-                        "Front",
-                        "Back",
-                        "Part-of-speech",
-                        "Base form",
-                        "Audio link",
-                    ],
-                ).drop_duplicates(ignore_index=True)
-
-                st.session_state["additional_outputs"] = pd.DataFrame(
-                    additional, columns=["Source", "Entry"]
-                ).drop_duplicates(subset=["Entry"], ignore_index=True)
-
-                st.session_state["generated_nothing"] = pd.DataFrame(
-                    generated_nothing, columns=["Source"]
-                ).drop_duplicates(ignore_index=True)
+            st.caption(f"jq filter cache: {utils.jq_cache.stats()}")
+            show_metrics()
 
             st.success(
                 f"Generated: \n{st.session_state['generated_cards'].shape[0]} cards, "
@@ -115,6 +315,62 @@ with import_cards:
                 + f"{st.session_state['generated_nothing'].shape[0]} entries did not generate any cards."
             )
 
+    elif data:
+        st.info(
+            f"Files with more than {EDITABLE_ROWS} entries can't be edited here. "
+            + "They're processed in chunks and the results are saved to files."
+        )
+        show_pages(partial(read_upload_page, data), total_rows, "vocab_page")
+
+        clicked = st.button("Generate cards")
+
+        if clicked:
+            with st.spinner("Translating"):
+                utils.metrics.reset()
+                job = start_job(data.getvalue(), restart)
+                bar = st.progress(0)
+                data.seek(0)
+                anki_index = st.session_state["anki_index"]
+                # Pick up any changes made in Anki since the last import
+                anki_index.invalidate()
+                clear_output_dir()
+                output_dir = tempfile.TemporaryDirectory(prefix="ankifier_")
+                st.session_state["output_dir"] = output_dir
+
+                read = 0
+                with utils.OutputFiles(output_dir.name) as out:
+                    results = utils.stream_cards(
+                        utils.read_vocab(data),
+                        utils.context_from_session_state(),
+                        anki_index,
+                        job,
+                    )
+                    for result in results:
+                        out.write(result)
+                        read += result.read
+                        bar.progress(min(1, read / total_rows))
+                bar.empty()
+
+                # The tables could be too big to keep in the session, so only
+                # keep track of the files
+                for key in ["generated_cards", "additional_outputs"]:
+                    st.session_state.pop(key, None)
+                st.session_state.pop("generated_nothing", None)
+                st.session_state["generated_files"] = out.paths
+                st.session_state["generated_counts"] = out.counts
+                st.session_state["import_job"] = job
+
+            st.caption(f"jq filter cache: {utils.jq_cache.stats()}")
+            show_metrics()
+
+            st.success(
+                f"Generated: \n{out.counts['cards']} cards, "
+                + f"{out.counts['additional']} related entries.\n"
+                + f"{out.counts['generated_nothing']} entries did not generate "
+                + "any cards.\n"
+                + f"Saved to {output_dir.name} until the next import"
+            )
+
 with edit_cards:
     choice = st.radio("Choose an option:", ["Use import", "Upload existing file"])
     if choice == "Use import":
@@ -127,41 +383,106 @@ with edit_cards:
                 num_rows="dynamic",
                 use_container_width=True,
             )
+        elif "generated_files" in st.session_state:
+            path = st.session_state["generated_files"]["cards"]
+            count = st.session_state["generated_counts"]["cards"]
+            st.write(f"Generated {count} cards, saved to {path}")
+            show_pages(partial(utils.read_output_page, path), count, "cards_page")
+            with open(path, "rb") as f:
+                st.download_button("Download cards", f, file_name="cards.csv")
     else:
         data = st.file_uploader("Upload a file to edit:", type=["csv", "txt"])
 
         if data:
+            import pandas as pd
+
             data_df = pd.read_csv(data, sep=",")
-            data_df.columns = [
-                "Front",
-                "Back",
-                "Part-of-speech",
-                "Base form",
-                "Audio link",
-            ]
+            data_df.columns = utils.CARD_COLUMNS
             edited_df = st.data_editor(
                 data_df, hide_index=True, num_rows="dynamic", use_container_width=True
             )
 
     clicked = st.button("Write cards to Anki")
     if clicked:
-        with st.spinner("Writing to Anki"):
-            errors = utils.write_df_to_anki(
-                edited_df,
-                st.session_state["language_anki_deck"],
-                st.session_state["language_anki_card_type"],
+        streamed = (
+            choice == "Use import"
+            and "generated_cards" not in st.session_state
+            and "generated_files" in st.session_state
+        )
+        if streamed:
+            # Too many cards to load at once, so write them a chunk at a time
+            import pandas as pd
+
+            to_write = pd.read_csv(
+                st.session_state["generated_files"]["cards"],
+                chunksize=utils.VOCAB_CHUNK_SIZE,
+                keep_default_na=False,
             )
-        count_errors = len(errors)
-        count_written = edited_df.shape[0] - count_errors
-        st.success(f"Wrote {count_written} cards to Anki")
+        else:
+            to_write = [edited_df]
+
+        try:
+            with st.spinner("Writing to Anki"):
+                bar = st.progress(0)
+                errors = []
+                count_cards = 0
+                for cards_df in to_write:
+                    errors.extend(
+                        utils.write_df_to_anki(
+                            cards_df,
+                            st.session_state["language_anki_deck"],
+                            st.session_state["language_anki_card_type"],
+                            st.session_state["anki_index"],
+                            st.session_state["config"]["ankifier_config"].get(
+                                "anki_batch_size", utils.ANKI_WRITE_BATCH_SIZE
+                            ),
+                            None if streamed else bar,
+                            st.session_state.get("audio_cache"),
+                            # Don't send cards from the import again if they've
+                            # already been written
+                            (
+                                st.session_state.get("import_job")
+                                if choice == "Use import"
+                                else None
+                            ),
+                        )
+                    )
+                    count_cards += cards_df.shape[0]
+                    if streamed:
+                        total = st.session_state["generated_counts"]["cards"]
+                        bar.progress(min(1, count_cards / max(total, 1)))
+                bar.empty()
+        except utils.AnkiConnectError as e:
+            st.error(f"Couldn't write to Anki: {e}")
+        else:
+            if choice == "Use import" and st.session_state.get("import_job"):
+                st.session_state["import_job"].finish_writing()
+            count_errors = len(errors)
+            count_written = count_cards - count_errors
+            st.success(f"Wrote {count_written} cards to Anki")
+            if errors:
+                import pandas as pd
+
+                st.warning(f"{count_errors} cards could not be written")
+                st.dataframe(
+                    pd.DataFrame(errors, columns=["Base form", "Error"]),
+                    hide_index=True,
+                    use_container_width=True,
+                )
 
 with look_up_cards:
     search = st.text_input("Enter word to look up", key="lookup")
 
     if search:
         with st.spinner("Searching"):
-            output = utils.look_up_word(
-                st.session_state["mongo_coll"], utils.strip_stress_marks(search)
+            coll = st.session_state["context"].coll
+            forms_coll = st.session_state["context"].forms_coll
+            output = look_up(
+                coll,
+                coll.full_name,
+                utils.strip_stress_marks(search),
+                forms_coll,
+                forms_coll.full_name if forms_coll is not None else None,
             )
 
         # Track how many entries we've seen to generate unique keys for the text_input field
@@ -169,9 +490,8 @@ with look_up_cards:
 
         for entry in output:
             pos = entry["pos"]
-            fields = st.session_state["language_config"].get(
-                entry["pos"], st.session_state["language_config"]["default"]
-            )
+            language_config = st.session_state["context"].language_config
+            fields = language_config.get(entry["pos"], language_config["default"])
             st.write("Word has part of speech:")
             st.write(pos)
             st.write("Your jq filter is: ")
@@ -207,14 +527,19 @@ with look_up_cards:
                         "Part-of-speech": card.pos,
                         "Audio link": card.audio,
                     }
-                    response = utils.write_card(
-                        st.session_state["language_anki_deck"],
-                        st.session_state["language_anki_card_type"],
-                        card_contents,
-                    )
+                    try:
+                        response = utils.write_card(
+                            st.session_state["language_anki_deck"],
+                            st.session_state["language_anki_card_type"],
+                            card_contents,
+                            st.session_state.get("audio_cache"),
+                        )
+                    except utils.AnkiConnectError as e:
+                        response = {"result": None, "error": str(e)}
                 if response["error"]:
                     st.error(f"Error with {base}, {response['error']}")
                 else:
+                    st.session_state["anki_index"].invalidate()
                     st.success("Wrote card to Anki")
 
             custom = st.text_input(
@@ -249,3 +574,23 @@ with related_cards:
             num_rows="dynamic",
             use_container_width=True,
         )
+
+    if "generated_files" in st.session_state and (
+        "additional_outputs" not in st.session_state
+    ):
+        files = st.session_state["generated_files"]
+        counts = st.session_state["generated_counts"]
+
+        st.write(f"Generated {counts['additional']} additional cards")
+        show_pages(
+            partial(utils.read_output_page, files["additional"]),
+            counts["additional"],
+            "additional_page",
+        )
+
+        st.write(f"{counts['generated_nothing']} entries did not generate any cards")
+        show_pages(
+            partial(utils.read_output_page, files["generated_nothing"]),
+            counts["generated_nothing"],
+            "generated_nothing_page",
+        )
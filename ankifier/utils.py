@@ -1,16 +1,315 @@
+from __future__ import annotations
+
+import contextlib
+import csv
+import hashlib
+import http.client
+import io
 import itertools
 import json
 import logging
-import urllib
-from typing import List, Tuple
+import os
+import queue
+import re
+import select
+import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache, wraps
+from typing import TYPE_CHECKING, Iterator, List, NamedTuple, Tuple
+
+# jq, pandas, SpaCy, Streamlit and the backends' clients are slow to import, so
+# they're imported where they're used. That way scripts which only need, say,
+# strip_stress_marks start up without loading them all.
+if TYPE_CHECKING:
+    import pandas as pd
+    from spacy import Language
+
+# Columns of the tables of generated cards and other outputs
+CARD_COLUMNS = ["Front", "Back", "Part-of-speech", "Base form", "Audio link"]
+ADDITIONAL_COLUMNS = ["Source", "Entry"]
+GENERATED_NOTHING_COLUMNS = ["Source"]
+
+# Number of vocab rows to generate cards for at a time when streaming
+VOCAB_CHUNK_SIZE = 1000
+# Number of hashes a SeenSet keeps in memory before moving them to disk
+SEEN_SET_MEMORY_LIMIT = 1_000_000
+
+# Filters that are run on every entry regardless of the language config
+BASE_FILTER = ".word"
+AUDIO_FILTER = '.sounds[] | select(.text == "Audio") | .mp3_url'
+EXAMPLES_FILTER = "(.senses[].examples[]?) | (.text, .english) | select(. != null)"
+RELATED_FILTER = "(.related[]?.word)"
+ALSO_RELATED_FILTER = "(.senses[] | .synonyms, .antonyms) | select(. != null)[] | .word"
+
+# Top-level entry fields the filters above read
+BUILTIN_FIELDS = {"word", "pos", "forms", "senses", "sounds", "related"}
+
+# Upper bound on the number of compiled jq programs we keep around
+JQ_CACHE_SIZE = 256
+
+# Pipeline components that don't affect the lemma, POS or tag of a token
+UNUSED_SPACY_PIPES = ["parser", "ner", "senter"]
+SPACY_BATCH_SIZE = 256
+
+# Number of words to look up per Mongo $in query
+MONGO_LOOKUP_CHUNK = 500
+# Tags Kaikki puts on rows of a forms table which describe the table rather
+# than being forms of the word
+FORM_TAGS_TO_SKIP = {"table-tags", "inflection-template", "class", "romanization"}
+
+# Language we translate phrases into
+TARGET_LANG = "EN-GB"
+# Number of phrases to send to DeepL per request
+DEEPL_BATCH_SIZE = 50
+
+# Default number of requests we make to each backend at the same time
+CONCURRENCY_LIMITS = {"mongo": 4, "ankiconnect": 2, "deepl": 2}
+
+# Bump to invalidate everything in the generation cache
+CACHE_VERSION = 2
+# Number of keys per SQLite "IN (...)" query, to stay under SQLite's limit on
+# the number of query parameters
+SQLITE_IN_CHUNK = 500
+
+# Number of notes to request per AnkiConnect notesInfo call
+ANKI_NOTES_INFO_CHUNK = 1000
+
+ANKICONNECT_HOST = "127.0.0.1"
+ANKICONNECT_PORT = 8765
+# Seconds to wait for AnkiConnect to answer. Adding notes with audio waits for
+# Anki to download every recording, so this is generous.
+ANKICONNECT_TIMEOUT = 60
+# Times to retry a request AnkiConnect couldn't be reached for, waiting
+# ANKICONNECT_BACKOFF seconds before the first retry and doubling after that
+ANKICONNECT_RETRIES = 3
+ANKICONNECT_BACKOFF = 0.5
+# Default number of notes to send to AnkiConnect per request when writing
+ANKI_WRITE_BATCH_SIZE = 100
+# What AnkiConnect says when addNote is given a note that's already in the deck
+ANKI_DUPLICATE_ERROR = "cannot create note because it is a duplicate"
+
+# Number of recordings to download at once when filling the audio cache
+AUDIO_PREFETCH_WORKERS = 8
+# Wikimedia asks that clients downloading its files identify themselves
+AUDIO_USER_AGENT = "Ankifier (https://github.com/andmikey/ankifier)"
+
+# Upper bounds (in seconds) of the latency histogram buckets kept by Metrics
+METRICS_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]
+
+
+class JqCache:
+    # Compiling a jq filter is far more expensive than running it, and we run
+    # the same handful of filters (from the language config) on every entry,
+    # so keep the compiled programs in a bounded LRU cache keyed by filter text
+    def __init__(self, maxsize: int = JQ_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._programs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, fields: str):
+        with self._lock:
+            program = self._programs.get(fields)
+            if program is not None:
+                self._programs.move_to_end(fields)
+                self.hits += 1
+                return program
+            self.misses += 1
+
+        # Compile outside the lock; raises ValueError for invalid filters,
+        # which are deliberately not cached
+        import jq
+
+        program = jq.compile(fields)
+
+        with self._lock:
+            self._programs[fields] = program
+            self._programs.move_to_end(fields)
+            while len(self._programs) > self.maxsize:
+                self._programs.popitem(last=False)
+        return program
+
+    def warm(self, language_config: dict):
+        # Pre-compile every filter we know we're going to need
+        filters = [
+            BASE_FILTER,
+            AUDIO_FILTER,
+            EXAMPLES_FILTER,
+            RELATED_FILTER,
+            ALSO_RELATED_FILTER,
+        ]
+        for pos_config in language_config.values():
+            filters.extend([pos_config["front"], pos_config["back"]])
+            filters.append(
+                build_combined_filter(pos_config["front"], pos_config["back"])
+            )
+
+        for fields in filters:
+            try:
+                self.get(fields)
+            except ValueError:
+                logging.warning(f"Could not compile jq filter: {fields}")
+
+    def clear(self):
+        with self._lock:
+            self._programs.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._programs),
+            }
+
+
+jq_cache = JqCache()
+
+
+class Timing:
+    # Latency histogram for one kind of call or stage
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(METRICS_BUCKETS) + 1)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+
+class Metrics:
+    # Counters and latency histograms for each pipeline stage and each call to
+    # Mongo, AnkiConnect, DeepL, SpaCy and jq. Off unless enabled, in which case
+    # timer() hands back a shared do-nothing context manager so instrumented
+    # code costs next to nothing.
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.counters = {}
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def timer(self, name: str):
+        if not self.enabled:
+            return NULL_TIMER
+        return MetricsTimer(self, name)
+
+    def timed(self, name: str):
+        # Decorator version of timer(), checked on every call so metrics can
+        # be turned on after the function is defined
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with MetricsTimer(self, name):
+                    return fn(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = Timing()
+            timing.observe(seconds)
+
+    def count(self, name: str, n: int = 1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.timings = {}
+
+    def summary(self) -> List[dict]:
+        # One row per timed stage or call, slowest first
+        with self._lock:
+            rows = [
+                {
+                    "name": name,
+                    "count": t.count,
+                    "total_s": round(t.total, 4),
+                    "mean_ms": round(1000 * t.total / t.count, 3),
+                    "max_ms": round(1000 * t.max, 3),
+                }
+                for name, t in self.timings.items()
+            ]
+        return sorted(rows, key=lambda row: row["total_s"], reverse=True)
+
+    def to_json(self) -> str:
+        with self._lock:
+            counters = dict(self.counters)
+        return json.dumps({"counters": counters, "timings": self.summary()}, indent=2)
+
+    def to_prometheus(self) -> str:
+        # Prometheus text exposition format
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                metric = "ankifier_" + re.sub(r"\W", "_", name) + "_total"
+                lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+
+            if self.timings:
+                metric = "ankifier_duration_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+            for name, t in sorted(self.timings.items()):
+                label = f'name="{name}"'
+                cumulative = 0
+                bounds = [str(bound) for bound in METRICS_BUCKETS] + ["+Inf"]
+                for bound, bucket in zip(bounds, t.buckets):
+                    cumulative += bucket
+                    lines.append(
+                        f'{metric}_bucket{{{label},le="{bound}"}} {cumulative}'
+                    )
+                lines.append(f"{metric}_sum{{{label}}} {t.total}")
+                lines.append(f"{metric}_count{{{label}}} {t.count}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsTimer:
+    def __init__(self, metrics: Metrics, name: str):
+        self.metrics = metrics
+        self.name = name
 
-import jq
-import streamlit as st
-from spacy import Language
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe(self.name, time.perf_counter() - self.started)
+
+
+NULL_TIMER = contextlib.nullcontext()
+
+metrics = Metrics()
 
 
 # TODO refactor
 class Card:
+    # Big imports create a lot of these, so don't give each one a __dict__
+    __slots__ = ("front", "back", "pos", "base", "audio")
+
     def __init__(self, front: str, back: str, pos: str, base: str, audio_url: str):
         self.front = front
         self.back = back
@@ -22,21 +321,42 @@ class Card:
         return f"{self.front}|{self.back}|{self.pos}|{self.base}|{self.audio}"
 
     def __repr__(self):
-        return self.__str__
+        return f"Card({', '.join(repr(field) for field in self.as_tuple())})"
 
     def __eq__(self, card):
+        if not isinstance(card, Card):
+            return NotImplemented
         return (self.base == card.base) and (self.pos == card.pos)
 
+    def __hash__(self):
+        # Consistent with __eq__: a card is identified by its base form and POS
+        return hash((self.base, self.pos))
+
     def as_tuple(self):
         return (self.front, self.back, self.pos, self.base, self.audio)
 
 
+class EntryFields(NamedTuple):
+    # Everything we pull out of a single Wiktionary entry
+    front: List[str]
+    back: List[str]
+    base: List[str]
+    audio: str
+    examples: List[str]
+    related: List[str]
+
+
 class Word:
-    def __init__(self, word: str, pos: str, config: dict, coll):
+    __slots__ = ("word", "pos", "config", "coll", "single_pass", "examples", "related")
+
+    def __init__(
+        self, word: str, pos: str, config: dict, coll, single_pass: bool = True
+    ):
         self.word = word
         self.pos = pos
         self.config = config
         self.coll = coll
+        self.single_pass = single_pass
         self.examples = []
         self.related = []
 
@@ -44,8 +364,11 @@ class Word:
         # Return config for this POS
         return self.config.get(pos, self.config["default"])
 
-    def generate_cards(self) -> List[Card]:
-        entries = look_up_word(self.coll, self.word)
+    def generate_cards(self, entries=None) -> List[Card]:
+        # Entries can be passed in if they've already been fetched in bulk
+        if entries is None:
+            with metrics.timer("mongo.find"):
+                entries = list(look_up_word(self.coll, self.word))
 
         cards_to_output = []
 
@@ -56,38 +379,18 @@ class Word:
             pos = entry["pos"]
 
             config = self.retrieve_config(pos)
-            config_front = config["front"]
-            config_back = config["back"]
+            fields = extract_entry_fields(entry, config, self.single_pass)
 
             # Generate card just for this word
-            base = retrieve_fields(entry, ".word")
-            audio_link = get_audio(entry)
-            front_contents = retrieve_fields(entry, config_front)
-            back_contents = retrieve_fields(entry, config_back)
-
-            if front_contents is not None and back_contents is not None:
-                card = create_card_from_contents(
-                    front_contents, back_contents, base, pos, audio_link
-                )
+            if fields.front is not None and fields.back is not None:
+                card = create_card_from_fields(fields, pos)
                 cards_to_output.append(card)
 
             # Optional: choose examples and output to another file
-            examples = retrieve_fields(
-                entry, "(.senses[].examples[]?) | (.text, .english) | select(. != null)"
-            )
-            if examples is not None:
-                self.examples.extend(examples)
+            self.examples.extend(fields.examples)
 
             # Optional: choose related words and output to another file
-            related = retrieve_fields(entry, "(.related[]?.word)")
-            if related is not None:
-                self.related.extend(related)
-            also_related = retrieve_fields(
-                entry,
-                "(.senses[] | .synonyms, .antonyms) | select(. != null)[] | .word",
-            )
-            if also_related is not None:
-                self.related.extend(also_related)
+            self.related.extend(fields.related)
 
         # Generate cards for related words
         return cards_to_output
@@ -103,6 +406,9 @@ class Phrase:
         translator,
         coll,
         anki_deck: str,
+        single_pass: bool = True,
+        anki_index=None,
+        tokens: List[Tuple[str, str, str]] = None,
     ):
         self.phrase = phrase
         # For Russian, should be removed for other languages
@@ -113,38 +419,62 @@ class Phrase:
         self.translator = translator
         self.coll = coll
         self.anki_deck = anki_deck
+        self.single_pass = single_pass
+        self.anki_index = anki_index
+        # Can be passed in if the phrase has already been through SpaCy
+        self.tokens = tokens
         self.examples = []
         self.related = []
+        # Set if we skipped something because an earlier phrase in the same
+        # import already generated cards for it
+        self.covered_by_earlier = False
 
     def pre_process_phrase(self, phrase: str) -> List[Tuple[str, str]]:
         # Use SpaCy to extract lemmas
-        processed = self.spacy(phrase)
+        return token_tuples(self.spacy(phrase))
 
-        tokens = []
-        for token in processed:
-            lemma = token.lemma_
-            pos = token.pos_
-            detailed_pos = token.tag_
-            tokens.append((lemma, pos, detailed_pos))
+    def get_tokens(self) -> List[Tuple[str, str, str]]:
+        if self.tokens is None:
+            self.tokens = self.pre_process_phrase(self.cleaned_phrase)
+        return self.tokens
 
-        return tokens
+    def get_lemmas(self) -> List[Tuple[str, str]]:
+        lemmas = []
+        for lemma, pos, detailed_pos in self.get_tokens():
+            if pos == "PROPN":
+                lemma = lemma.capitalize()
+            lemmas.append((lemma, pos))
+        return lemmas
 
-    def generate_cards(self) -> List[Card]:
+    def generate_cards(
+        self,
+        entries_by_word: dict = None,
+        word_outputs: dict = None,
+        translations: dict = None,
+    ) -> List[Card]:
         cards: List[Card] = []
 
         # Look up all the individual (lemmatized) words and generate cards for these
-        tokens = self.pre_process_phrase(self.cleaned_phrase)
-        for lemma, pos, detailed_pos in tokens:
-            if pos == "PROPN":
-                lemma = lemma.capitalize()
-
+        tokens = self.get_tokens()
+        for lemma, pos in self.get_lemmas():
             # Only generate for words not already in Anki
             if not self.exists_in_anki(lemma):
-                word = Word(lemma, pos, self.config, self.coll)
-                cards_for_lemma = word.generate_cards()
+                if word_outputs is not None and lemma in word_outputs:
+                    # Generated on a previous run and loaded from the cache
+                    cards_for_lemma, examples, related = word_outputs[lemma]
+                else:
+                    word = Word(lemma, pos, self.config, self.coll, self.single_pass)
+                    entries = None
+                    if entries_by_word is not None:
+                        entries = entries_by_word.get(lemma)
+                    cards_for_lemma = word.generate_cards(entries)
+                    examples, related = word.examples, word.related
+                    if word_outputs is not None:
+                        word_outputs[lemma] = (cards_for_lemma, examples, related)
                 cards.extend(cards_for_lemma)
-                self.examples.extend(word.examples)
-                self.related.extend(word.related)
+                self.mark_generated(cards_for_lemma)
+                self.examples.extend(examples)
+                self.related.extend(related)
 
         # Translate the whole phrase
         if len(tokens) > 1:
@@ -153,11 +483,16 @@ class Phrase:
                 if self.translation != "":
                     # Already have a translation provided
                     translation = self.translation
+                elif translations is not None and self.cleaned_phrase in translations:
+                    # Translated up front along with the rest of the import
+                    translation = translations[self.cleaned_phrase]
                 else:
                     # Run through the translator
-                    translation = self.translator.translate_text(
-                        self.cleaned_phrase, target_lang="EN-GB"
-                    )
+                    with metrics.timer("deepl.translate"):
+                        translation = self.translator.translate_text(
+                            self.cleaned_phrase, target_lang=TARGET_LANG
+                        )
+                    translation = getattr(translation, "text", translation)
                 overall_translation = Card(
                     self.phrase,
                     translation,
@@ -166,17 +501,30 @@ class Phrase:
                     "",
                 )
                 cards.append(overall_translation)
+                self.mark_generated([overall_translation])
 
         logging.info(
             f"Generated {len(cards)} cards for {self.phrase}, "
             + f"{len(self.examples) + len(self.related)} additional cards"
         )
-        return [c.as_tuple() for c in cards]
+        return cards
 
     def get_additional_outputs(self) -> List[str]:
         return self.related + self.examples
 
+    def mark_generated(self, cards: List[Card]):
+        if self.anki_index is not None:
+            for card in cards:
+                self.anki_index.add(card.base)
+
     def exists_in_anki(self, entry: str) -> bool:
+        metrics.count("anki.exists_checks")
+        if self.anki_index is not None:
+            if self.anki_index.was_generated(entry):
+                self.covered_by_earlier = True
+                return True
+            return self.anki_index.in_anki(entry)
+
         search_query = f'deck:{self.anki_deck} "Base form:{entry}"'
         request = {
             "action": "findCards",
@@ -184,46 +532,1026 @@ class Phrase:
             "version": 6,
         }
 
-        response = call_ankiconnect(request)
+        response = ankiconnect.call(request)
         count_matches = len(response["result"])
         return count_matches > 0
 
 
-def parse_df_to_cards(df, bar):
-    # Takes DataFrame where each row is a word/phrase and outputs:
+class AnkiIndex:
+    # In-memory copy of the "Base form" field of every note in the deck, so we
+    # can check whether something is already in Anki without making a request
+    # to AnkiConnect for every word
+    def __init__(self, deck: str):
+        self.deck = deck
+        self.existing = set()
+        # Base forms we've generated cards for since the index was loaded
+        self.generated = set()
+        self.loaded = False
+
+    @metrics.timed("stage.load_anki_index")
+    def load(self, executor: ThreadPoolExecutor = None):
+        request = {
+            "action": "findNotes",
+            "params": {"query": f"deck:{self.deck}"},
+            "version": 6,
+        }
+        note_ids = ankiconnect.call(request)["result"] or []
+
+        def notes_info(i):
+            request = {
+                "action": "notesInfo",
+                "params": {"notes": note_ids[i : i + ANKI_NOTES_INFO_CHUNK]},
+                "version": 6,
+            }
+            return ankiconnect.call(request)["result"] or []
+
+        existing = set()
+        chunks = range(0, len(note_ids), ANKI_NOTES_INFO_CHUNK)
+        for notes in run_all(executor, notes_info, chunks):
+            for note in notes:
+                base = note["fields"].get("Base form")
+                if base is not None:
+                    existing.add(self._key(base["value"]))
+
+        logging.info(f"Loaded {len(existing)} base forms from {self.deck}")
+        metrics.count("anki.notes_loaded", len(existing))
+        self.existing = existing
+        self.generated = set()
+        self.loaded = True
+
+    def ensure_loaded(self, executor: ThreadPoolExecutor = None):
+        if not self.loaded:
+            self.load(executor)
+
+    def invalidate(self):
+        # Force a reload from Anki the next time the index is queried
+        self.loaded = False
+
+    def add(self, base: str):
+        self.generated.add(self._key(base))
+
+    def add_written(self, bases: List[str]):
+        # Base forms of notes just added to the deck, so the index stays up to
+        # date without reloading the whole deck from Anki
+        self.existing.update(self._key(base) for base in bases)
+
+    def in_anki(self, base: str) -> bool:
+        if not self.loaded:
+            self.load()
+        return self._key(base) in self.existing
+
+    def was_generated(self, base: str) -> bool:
+        return self._key(base) in self.generated
+
+    def __contains__(self, base: str) -> bool:
+        return self.was_generated(base) or self.in_anki(base)
+
+    def _key(self, base: str) -> str:
+        # Anki's field search is case-insensitive
+        return base.strip().casefold()
+
+
+class GenerationCache:
+    # On-disk cache of SpaCy tokens for each phrase, and of the cards and
+    # additional outputs generated for each lemma, so re-importing overlapping
+    # vocab lists skips SpaCy, Mongo and jq for anything we've seen before.
+    # Whole phrases aren't cached because which of their words need cards
+    # depends on what's in Anki at the time.
+    #
+    # Entries are namespaced by a hash of everything that affects them
+    # (language, SpaCy model, language config, Wiktionary and forms
+    # collections), so editing the config or switching to a different
+    # collection means the old entries simply stop being found.
+    def __init__(
+        self,
+        path: str,
+        language: str,
+        language_config: dict,
+        spacy_model,
+        collection: str,
+        forms_collection: str = None,
+    ):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self.conn:
+            for table in ["tokens", "words"]:
+                self.conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} (namespace TEXT, "
+                    + "key TEXT, value TEXT, PRIMARY KEY (namespace, key))"
+                )
+
+        self.tokens_namespace = config_hash([CACHE_VERSION, language, spacy_model])
+        self.words_namespace = config_hash(
+            [
+                CACHE_VERSION,
+                language,
+                language_config,
+                collection,
+                BASE_FILTER,
+                AUDIO_FILTER,
+                EXAMPLES_FILTER,
+                RELATED_FILTER,
+                ALSO_RELATED_FILTER,
+            ]
+            # Words without entries of their own can be found through the
+            # forms collection, so using one changes what they generate
+            + ([forms_collection] if forms_collection else [])
+        )
+
+    def get_tokens(self, phrases: List[str]) -> dict:
+        found = self._get("tokens", self.tokens_namespace, phrases)
+        return {k: [tuple(t) for t in v] for k, v in found.items()}
+
+    def put_tokens(self, tokens_by_phrase: dict):
+        self._put("tokens", self.tokens_namespace, tokens_by_phrase)
+
+    def get_words(self, words: List[str]) -> dict:
+        found = self._get("words", self.words_namespace, words)
+        return {
+            k: ([Card(*c) for c in v["cards"]], v["examples"], v["related"])
+            for k, v in found.items()
+        }
+
+    def put_words(self, word_outputs: dict):
+        values = {
+            word: {
+                "cards": [c.as_tuple() for c in cards],
+                "examples": examples,
+                "related": related,
+            }
+            for word, (cards, examples, related) in word_outputs.items()
+        }
+        self._put("words", self.words_namespace, values)
+
+    def clear(self):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM tokens")
+            self.conn.execute("DELETE FROM words")
+
+    def _get(self, table: str, namespace: str, keys: List[str]) -> dict:
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            rows = select_in(
+                self.conn,
+                f"SELECT key, value FROM {table} WHERE namespace = ? AND key IN",
+                [namespace],
+                keys,
+            )
+        return {key: json.loads(value) for key, value in rows}
+
+    def _put(self, table: str, namespace: str, values: dict):
+        with self._lock, self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?)",
+                [(namespace, k, json.dumps(v)) for k, v in values.items()],
+            )
+
+
+def config_hash(config) -> str:
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def select_in(conn, sql: str, params: list, keys: list) -> List[tuple]:
+    # Run a query ending in "IN" with the given parameters followed by each
+    # chunk of keys, returning the rows from every chunk
+    rows = []
+    for i in range(0, len(keys), SQLITE_IN_CHUNK):
+        chunk = keys[i : i + SQLITE_IN_CHUNK]
+        placeholders = ", ".join("?" * len(chunk))
+        rows.extend(conn.execute(f"{sql} ({placeholders})", [*params, *chunk]))
+    return rows
+
+
+class GenerationContext:
+    # Everything card generation needs, so it can run without Streamlit
+    def __init__(
+        self,
+        language_config: dict,
+        nlp: Language,
+        translator,
+        coll,
+        anki_deck: str,
+        single_pass: bool = True,
+        cache: GenerationCache = None,
+        translation_memory=None,
+        spacy_batch_size: int = SPACY_BATCH_SIZE,
+        spacy_n_process: int = 1,
+        concurrency: dict = None,
+        forms_coll=None,
+    ):
+        self.language_config = language_config
+        self.nlp = nlp
+        self.translator = translator
+        self.coll = coll
+        self.anki_deck = anki_deck
+        self.single_pass = single_pass
+        self.cache = cache
+        self.translation_memory = translation_memory
+        self.spacy_batch_size = spacy_batch_size
+        self.spacy_n_process = spacy_n_process
+        self.concurrency = {**CONCURRENCY_LIMITS, **(concurrency or {})}
+        # Optional collection built by build_forms_collection, for words SpaCy
+        # couldn't lemmatise to something in Wiktionary
+        self.forms_coll = forms_coll
+
+
+class SettingsLoaders:
+    # How context_from_settings loads the parts of a context. The app swaps
+    # these for versions that are cached across Streamlit reruns.
+    def language_config(self, path: str) -> dict:
+        import yaml
+
+        with open(path) as f:
+            language_config = yaml.safe_load(f)
+        # Compile the jq filters up front rather than on the first import
+        jq_cache.warm(language_config)
+        return language_config
+
+    def spacy(self, spacy_model: str) -> Language:
+        import spacy
+
+        return spacy.load(spacy_model)
+
+    def mongo_client(self):
+        from pymongo import MongoClient
+
+        return MongoClient(serverSelectionTimeoutMS=1000)
+
+    def translator(self, api_key: str):
+        import deepl
+
+        return deepl.Translator(api_key)
+
+    def generation_cache(
+        self, path, language, language_config, spacy_model, collection, forms_collection
+    ) -> GenerationCache:
+        return GenerationCache(
+            path, language, language_config, spacy_model, collection, forms_collection
+        )
+
+    def translation_memory(self, path: str) -> TranslationMemory:
+        return TranslationMemory(path)
+
+
+def context_from_settings(
+    config: dict,
+    language: str,
+    test_mode: bool = False,
+    loaders: SettingsLoaders = None,
+) -> GenerationContext:
+    # Build everything from a settings file. Used by both the app's Settings
+    # tab and the command line, so they always set things up the same way.
+    loaders = loaders or SettingsLoaders()
+    ankifier_config = config["ankifier_config"]
+    language_settings = config["language_configs"][language]
+
+    language_config = loaders.language_config(language_settings["word_settings"])
+
+    spacy_model = language_settings["spacy_model"]
+    nlp = loaders.spacy(spacy_model)
+
+    db = loaders.mongo_client()[ankifier_config["mongodb_name"]]
+    # Prefer the slimmed-down collection if one has been built
+    coll = db[
+        language_settings.get(
+            "slim_collection", language_settings["wiktionary_collection"]
+        )
+    ]
+    # Optional collection of inflected forms, for words SpaCy can't lemmatise
+    # to something in Wiktionary
+    forms_collection = language_settings.get("forms_collection")
+    forms_coll = db[forms_collection] if forms_collection else None
+
+    if test_mode:
+        translator = TestTranslator()
+    else:
+        translator = loaders.translator(ankifier_config["deepl_api_key"])
+
+    # Optional on-disk cache of generated cards
+    cache = None
+    if ankifier_config.get("cache_path"):
+        cache = loaders.generation_cache(
+            ankifier_config["cache_path"],
+            language,
+            language_config,
+            spacy_model,
+            coll.full_name,
+            forms_collection,
+        )
+
+    # Optional memory of previous DeepL translations
+    translation_memory = None
+    if ankifier_config.get("translation_memory_path"):
+        translation_memory = loaders.translation_memory(
+            ankifier_config["translation_memory_path"]
+        )
+
+    return GenerationContext(
+        language_config,
+        nlp,
+        translator,
+        coll,
+        language_settings["anki_deck"],
+        ankifier_config.get("single_pass_jq", True),
+        cache,
+        translation_memory,
+        ankifier_config.get("spacy_batch_size", SPACY_BATCH_SIZE),
+        ankifier_config.get("spacy_n_process", 1),
+        ankifier_config.get("concurrency"),
+        forms_coll,
+    )
+
+
+def context_from_session_state() -> GenerationContext:
+    # The context the app's Settings tab built with context_from_settings
+    import streamlit as st
+
+    return st.session_state["context"]
+
+
+def parse_df_to_cards(df, bar, anki_index=None, job: ImportJob = None):
+    # Takes DataFrame where each row is a word/phrase and outputs DataFrames of:
     # 1. Translated cards
     # 2. Additional cards which someone may want to add
-    cards_to_add = []
-    additional_outputs = []
-    generated_nothing = []
-
-    total_entries = df.shape[0]
-
-    for idx, row in df.iterrows():
-        progress = min(1, (idx + 1) / total_entries)
-        bar.progress(progress)
-        entry = row["Word"].strip()
-        translation = str(row["Translation"]).strip()
-        p = Phrase(
-            entry,
-            translation,
-            st.session_state["language_config"],
-            st.session_state["nlp"],
-            st.session_state["translator"],
-            st.session_state["mongo_coll"],
-            st.session_state["language_anki_deck"],
+    # 3. Entries which didn't generate anything
+    # Duplicate rows are skipped, keeping the first
+    rows = dict.fromkeys(
+        (word.strip(), str(translation).strip())
+        for word, translation in zip(df["Word"], df["Translation"])
+    )
+
+    # Pick up any changes made in Anki since the last import
+    if anki_index is not None:
+        anki_index.invalidate()
+
+    context = context_from_session_state()
+    if job is None:
+        collector = generate_cards_for_rows(
+            list(rows), context, anki_index, bar.progress
+        )
+        return collector.frames()
+
+    # Go through the rows a chunk at a time, so whatever's finished is kept in
+    # the job if something fails
+    import pandas as pd
+
+    rows = list(rows)
+    chunks = [
+        rows[i : i + VOCAB_CHUNK_SIZE] for i in range(0, len(rows), VOCAB_CHUNK_SIZE)
+    ]
+    cards, additional, generated_nothing = [], [], []
+    read = 0
+    for result in stream_cards(chunks, context, anki_index, job):
+        cards.extend(result.cards)
+        additional.extend(result.additional)
+        generated_nothing.extend(result.generated_nothing)
+        read += result.read
+        bar.progress(min(1, read / max(len(rows), 1)))
+    return (
+        pd.DataFrame(cards, columns=CARD_COLUMNS),
+        pd.DataFrame(additional, columns=ADDITIONAL_COLUMNS),
+        pd.DataFrame(generated_nothing, columns=GENERATED_NOTHING_COLUMNS),
+    )
+
+
+class CardCollector:
+    # Collects generated cards, additional outputs and entries which generated
+    # nothing, dropping duplicates as they're added rather than in a separate
+    # pass afterwards. Each table is kept as one list per column so it can be
+    # turned into a DataFrame without building a tuple per row.
+    #
+    # Cards are only dropped if every field matches, the same as
+    # DataFrame.drop_duplicates; two senses of a word with the same base form
+    # and POS are both kept. Additional outputs are deduplicated on the entry.
+    def __init__(self, seen: dict = None):
+        # Anything with `in` and `add` can be used to track what's been seen,
+        # e.g. a SeenSet shared between the chunks of a streamed import
+        self.seen = seen or {
+            "cards": set(),
+            "additional": set(),
+            "generated_nothing": set(),
+        }
+        self.cards = {column: [] for column in CARD_COLUMNS}
+        self.additional = {column: [] for column in ADDITIONAL_COLUMNS}
+        self.generated_nothing = {column: [] for column in GENERATED_NOTHING_COLUMNS}
+
+    def add_cards(self, cards: List[Card]):
+        seen = self.seen["cards"]
+        columns = list(self.cards.values())
+        for card in cards:
+            fields = card.as_tuple()
+            if fields in seen:
+                continue
+            seen.add(fields)
+            for column, value in zip(columns, fields):
+                column.append(value)
+
+    def add_additional(self, source: str, outputs: List[str]):
+        seen = self.seen["additional"]
+        sources, entries = self.additional.values()
+        for output in outputs:
+            if output in seen:
+                continue
+            seen.add(output)
+            sources.append(source)
+            entries.append(output)
+
+    def add_generated_nothing(self, source: str):
+        seen = self.seen["generated_nothing"]
+        if source not in seen:
+            seen.add(source)
+            self.generated_nothing[GENERATED_NOTHING_COLUMNS[0]].append(source)
+
+    def frames(self) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        import pandas as pd
+
+        return (
+            pd.DataFrame(self.cards),
+            pd.DataFrame(self.additional),
+            pd.DataFrame(self.generated_nothing),
+        )
+
+    def rows(self) -> Tuple[List[tuple], List[tuple], List[str]]:
+        return (
+            list(zip(*self.cards.values())),
+            list(zip(*self.additional.values())),
+            self.generated_nothing[GENERATED_NOTHING_COLUMNS[0]],
+        )
+
+
+def generate_cards_for_rows(
+    rows: List[Tuple[str, str]],
+    context: GenerationContext,
+    anki_index=None,
+    progress=None,
+    collector: CardCollector = None,
+) -> CardCollector:
+    # Takes (phrase, translation) pairs and returns the cards, additional
+    # outputs and entries which generated nothing.
+    #
+    # The slow parts are requests to AnkiConnect, Mongo and DeepL, so these are
+    # all made up front in batches, with requests to different backends running
+    # at the same time (up to a limit for each). Cards are then generated from
+    # the results one phrase at a time, in order, so the output is the same as
+    # generating each phrase in turn.
+    if collector is None:
+        collector = CardCollector()
+
+    if anki_index is None:
+        anki_index = AnkiIndex(context.anki_deck)
+    cache = context.cache
+
+    with (
+        ThreadPoolExecutor(1) as background,
+        ThreadPoolExecutor(context.concurrency["ankiconnect"]) as anki_pool,
+        ThreadPoolExecutor(context.concurrency["mongo"]) as mongo_pool,
+        ThreadPoolExecutor(context.concurrency["deepl"]) as deepl_pool,
+    ):
+        # Fetch everything that's already in the deck once up front rather than
+        # asking AnkiConnect about every word, while SpaCy runs
+        index_loaded = background.submit(anki_index.ensure_loaded, anki_pool)
+
+        # First pass: lemmatise everything and work out which words we need
+        metrics.count("rows", len(rows))
+        cleaned = strip_stress_marks_all([entry for entry, _ in rows])
+        with metrics.timer("stage.lemmatise"):
+            tokens_by_phrase = cache.get_tokens(cleaned) if cache is not None else {}
+            to_lemmatise = [
+                c for c in dict.fromkeys(cleaned) if c not in tokens_by_phrase
+            ]
+            metrics.count("cache.token_hits", len(tokens_by_phrase))
+            new_tokens = lemmatise_phrases(
+                context.nlp,
+                to_lemmatise,
+                context.spacy_batch_size,
+                context.spacy_n_process,
+            )
+            new_tokens = dict(zip(to_lemmatise, new_tokens))
+            tokens_by_phrase.update(new_tokens)
+            if cache is not None:
+                cache.put_tokens(new_tokens)
+
+        phrases = []
+        for (entry, translation), c in zip(rows, cleaned):
+            p = Phrase(
+                entry,
+                translation,
+                context.language_config,
+                context.nlp,
+                context.translator,
+                context.coll,
+                context.anki_deck,
+                context.single_pass,
+                anki_index,
+                tokens_by_phrase[c],
+            )
+            phrases.append(p)
+
+        with metrics.timer("stage.wait_for_anki_index"):
+            index_loaded.result()
+
+        # Translate every phrase that needs it in as few requests as possible,
+        # while we look up the words in Mongo
+        to_translate = [
+            p.cleaned_phrase
+            for p in phrases
+            if len(p.get_tokens()) > 1
+            and p.translation == ""
+            and not anki_index.in_anki(p.cleaned_phrase)
+        ]
+        translated = background.submit(
+            translate_phrases,
+            context.translator,
+            to_translate,
+            context.translation_memory,
+            executor=deepl_pool,
+        )
+
+        words = [
+            lemma
+            for p in phrases
+            for lemma, _ in p.get_lemmas()
+            if not anki_index.in_anki(lemma)
+        ]
+
+        with metrics.timer("stage.look_up"):
+            # Anything we generated on a previous run doesn't need looking up
+            word_outputs = cache.get_words(words) if cache is not None else {}
+            cached_words = set(word_outputs)
+            metrics.count("cache.word_hits", len(cached_words))
+
+            entries_by_word = look_up_words(
+                context.coll,
+                [word for word in words if word not in cached_words],
+                executor=mongo_pool,
+            )
+            # Words found through the forms collection leave out headwords that
+            # are already in Anki, so they aren't cached
+            from_forms = set()
+            if context.forms_coll is not None:
+                from_forms = fill_in_from_forms(
+                    context.forms_coll,
+                    context.coll,
+                    entries_by_word,
+                    anki_index,
+                    executor=mongo_pool,
+                )
+
+        with metrics.timer("stage.wait_for_translations"):
+            translations = translated.result()
+
+    # Second pass: generate cards from everything we've fetched
+    with metrics.timer("stage.generate"):
+        for idx, p in enumerate(phrases):
+            if progress is not None:
+                progress(min(1, (idx + 1) / len(phrases)))
+
+            cards = p.generate_cards(entries_by_word, word_outputs, translations)
+            collector.add_cards(cards)
+            # Examples, synonyms, antonyms, related words, etc
+            additional = p.get_additional_outputs()
+            collector.add_additional(p.phrase, additional)
+
+            if not cards and not additional and not p.covered_by_earlier:
+                collector.add_generated_nothing(p.phrase)
+
+    if cache is not None:
+        cache.put_words(
+            {
+                w: out
+                for w, out in word_outputs.items()
+                if w not in cached_words and w not in from_forms
+            }
+        )
+
+    logging.info(f"jq cache: {jq_cache.stats()}")
+    metrics.count("cards", len(collector.cards[CARD_COLUMNS[0]]))
+
+    return collector
+
+
+class StreamResult(NamedTuple):
+    # Outputs for one chunk of a streamed vocab file, with anything already
+    # output for an earlier chunk removed
+    read: int
+    rows: List[Tuple[str, str]]
+    cards: List[tuple]
+    additional: List[Tuple[str, str]]
+    generated_nothing: List[str]
+
+
+def read_vocab(source, chunk_size: int = VOCAB_CHUNK_SIZE):
+    # Read a vocab file (one entry, or "phrase | translation", per line) a
+    # chunk at a time, yielding lists of (phrase, translation) pairs
+    import pandas as pd
+
+    chunks = pd.read_csv(
+        source,
+        sep="|",
+        header=None,
+        names=["Word", "Translation"],
+        dtype=str,
+        chunksize=chunk_size,
+    )
+    for chunk in chunks:
+        chunk = chunk.fillna("")
+        yield [
+            (word.strip(), translation.strip())
+            for word, translation in zip(chunk["Word"], chunk["Translation"])
+            if word.strip()
+        ]
+
+
+def read_vocab_page(source, page: int, page_size: int):
+    # Read one page of a vocab file. Blank lines are skipped the same way as
+    # in count_lines, so the pages line up with the number of entries.
+    import pandas as pd
+
+    entries = (line for line in source if line.strip())
+    lines = list(itertools.islice(entries, page * page_size, (page + 1) * page_size))
+    if not lines:
+        return pd.DataFrame(columns=["Word", "Translation"])
+
+    text = "".join(line.decode() if isinstance(line, bytes) else line for line in lines)
+    return pd.read_csv(
+        io.StringIO(text),
+        sep="|",
+        header=None,
+        names=["Word", "Translation"],
+        dtype=str,
+    ).fillna("")
+
+
+def read_output_page(path: str, page: int, page_size: int):
+    # Read one page of a CSV file written by OutputFiles, keeping the header
+    import pandas as pd
+
+    return pd.read_csv(
+        path,
+        skiprows=range(1, 1 + page * page_size),
+        nrows=page_size,
+        keep_default_na=False,
+    )
+
+
+def count_lines(source) -> int:
+    # Count the lines in an open file (e.g. an upload) and rewind it
+    source.seek(0)
+    count = sum(1 for line in source if line.strip())
+    source.seek(0)
+    return count
+
+
+def stream_cards(
+    chunks, context: GenerationContext, anki_index=None, job: ImportJob = None
+) -> Iterator[StreamResult]:
+    # Generate cards for each chunk of (phrase, translation) pairs as it
+    # comes in, so the whole vocab file and its outputs never have to be in
+    # memory at once. Outputs are deduplicated across chunks the same way the
+    # app deduplicates its tables.
+    #
+    # With a job, each chunk is recorded as it finishes. If the job has been
+    # run before, the outputs of the rows it finished come first, and only
+    # the rest of the rows are generated.
+    if anki_index is None:
+        anki_index = AnkiIndex(context.anki_deck)
+
+    seen_rows = SeenSet()
+    seen = {
+        "cards": SeenSet(),
+        "additional": SeenSet(),
+        "generated_nothing": SeenSet(),
+    }
+
+    if job is not None:
+        done = [row for row in job.done_rows() if seen_rows.add(row)]
+        if done:
+            cards, additional, generated_nothing = job.outputs()
+            yield StreamResult(
+                0,
+                done,
+                [card for card in cards if seen["cards"].add(card)],
+                [row for row in additional if seen["additional"].add(row[1])],
+                [s for s in generated_nothing if seen["generated_nothing"].add(s)],
+            )
+
+    for chunk in chunks:
+        rows = [row for row in chunk if seen_rows.add(row)]
+        try:
+            collector = generate_cards_for_rows(
+                rows, context, anki_index, collector=CardCollector(seen)
+            )
+        except Exception as e:
+            # Leave a note of what went wrong, so the next run retries them
+            if job is not None:
+                job.record_failed(rows, repr(e))
+            raise
+        result = StreamResult(len(chunk), rows, *collector.rows())
+        if job is not None and rows:
+            job.record_done(result)
+        yield result
+
+    if job is not None:
+        job.finish_generating()
+
+
+class SeenSet:
+    # Remembers what we've already output using a 64-bit hash of each value
+    # rather than the value itself. Once there are too many hashes to keep in
+    # memory they're moved to a temporary SQLite database on disk.
+    def __init__(self, memory_limit: int = SEEN_SET_MEMORY_LIMIT):
+        self.memory_limit = memory_limit
+        self.in_memory = set()
+        self.db = None
+
+    def __contains__(self, value) -> bool:
+        return self._contains_key(self._hash(value))
+
+    def _contains_key(self, key: int) -> bool:
+        if key in self.in_memory:
+            return True
+        if self.db is not None:
+            found = self.db.execute("SELECT 1 FROM seen WHERE key = ?", (key,))
+            return found.fetchone() is not None
+        return False
+
+    def add(self, value) -> bool:
+        # Returns True if the value hadn't been seen before
+        key = self._hash(value)
+        if self._contains_key(key):
+            return False
+
+        self.in_memory.add(key)
+        if len(self.in_memory) >= self.memory_limit:
+            self._spill()
+        return True
+
+    def _spill(self):
+        if self.db is None:
+            # An empty path gives a temporary database that's deleted on close
+            self.db = sqlite3.connect("")
+            self.db.execute("CREATE TABLE seen (key INTEGER PRIMARY KEY)")
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO seen VALUES (?)",
+                [(key,) for key in self.in_memory],
+            )
+        self.in_memory = set()
+
+    def _hash(self, value) -> int:
+        digest = hashlib.blake2b(
+            json.dumps(value, ensure_ascii=False).encode(), digest_size=8
+        ).digest()
+        return int.from_bytes(digest, "big", signed=True)
+
+
+class OutputFiles:
+    # The card, additional output and generated-nothing files for a streamed
+    # import, written to as each chunk is generated
+    def __init__(self, output_dir: str, output_format: str = "csv"):
+        os.makedirs(output_dir, exist_ok=True)
+        self.paths = {
+            name: os.path.join(output_dir, f"{name}.{output_format}")
+            for name in ["cards", "additional", "generated_nothing"]
+        }
+        self.cards = OutputWriter(self.paths["cards"], CARD_COLUMNS, output_format)
+        self.additional = OutputWriter(
+            self.paths["additional"], ADDITIONAL_COLUMNS, output_format
+        )
+        self.generated_nothing = OutputWriter(
+            self.paths["generated_nothing"], GENERATED_NOTHING_COLUMNS, output_format
+        )
+        self.counts = {"rows": 0, "cards": 0, "additional": 0, "generated_nothing": 0}
+
+    def write(self, result: StreamResult):
+        self.cards.write(result.cards)
+        self.additional.write(result.additional)
+        self.generated_nothing.write([(source,) for source in result.generated_nothing])
+        self.counts["rows"] += len(result.rows)
+        self.counts["cards"] += len(result.cards)
+        self.counts["additional"] += len(result.additional)
+        self.counts["generated_nothing"] += len(result.generated_nothing)
+
+    def close(self):
+        self.cards.close()
+        self.additional.close()
+        self.generated_nothing.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class OutputWriter:
+    # Appends rows to a CSV or JSONL file as they're generated
+    def __init__(self, path: str, columns: List[str], output_format: str = "csv"):
+        self.columns = columns
+        self.output_format = output_format
+        self.file = open(path, "w", newline="")
+        if output_format == "csv":
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(columns)
+
+    def write(self, rows: List[tuple]):
+        for row in rows:
+            if self.output_format == "csv":
+                self.writer.writerow(row)
+            else:
+                record = dict(zip(self.columns, row))
+                self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def job_id(source: bytes, context: GenerationContext, spacy_model: str) -> str:
+    # Importing the same vocab into the same deck with the same settings is
+    # the same job. Like the generation cache's namespace, that includes the
+    # collections and SpaCy model, as well as the kind of translator so a run
+    # in testing mode isn't carried on from with DeepL.
+    return config_hash(
+        [
+            hashlib.sha256(source).hexdigest(),
+            context.language_config,
+            context.anki_deck,
+            spacy_model,
+            context.coll.full_name,
+            context.forms_coll.full_name if context.forms_coll is not None else None,
+            type(context.translator).__name__,
+        ]
+    )
+
+
+class JobStore:
+    # Keeps track of imports in SQLite, so one that fails part way through
+    # (Mongo timing out, Anki being closed, running out of DeepL quota) can be
+    # run again without redoing the rows it finished. Each row is recorded as
+    # done or failed, and the outputs are saved a chunk at a time. Also keeps
+    # track of the notes each job has written to Anki, so writing its cards
+    # again only sends the ones that didn't make it. Once generating or
+    # writing finishes, its records are cleared, so only runs that failed or
+    # were interrupted are carried on from.
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS rows (job TEXT, phrase TEXT, "
+                + "translation TEXT, status TEXT, error TEXT, "
+                + "PRIMARY KEY (job, phrase, translation))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS outputs (job TEXT, value TEXT)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS outputs_job ON outputs (job)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS written (job TEXT, note TEXT, "
+                + "PRIMARY KEY (job, note))"
+            )
+
+    def job(self, job_id: str) -> ImportJob:
+        return ImportJob(self, job_id)
+
+    def clear(self, job_id: str = None):
+        with self._lock, self.conn:
+            for table in ["rows", "outputs", "written"]:
+                if job_id is None:
+                    self.conn.execute(f"DELETE FROM {table}")
+                else:
+                    self.conn.execute(f"DELETE FROM {table} WHERE job = ?", [job_id])
+
+
+class ImportJob:
+    # One import's records in a JobStore
+    def __init__(self, store: JobStore, job_id: str):
+        self.store = store
+        self.id = job_id
+
+    def done_rows(self) -> List[Tuple[str, str]]:
+        with self.store._lock:
+            rows = self.store.conn.execute(
+                "SELECT phrase, translation FROM rows WHERE job = ? "
+                + "AND status = 'done' ORDER BY rowid",
+                [self.id],
+            )
+            return [tuple(row) for row in rows]
+
+    def outputs(self) -> Tuple[List[tuple], List[tuple], List[str]]:
+        # Everything generated for the rows that are done, in the order the
+        # chunks finished
+        cards, additional, generated_nothing = [], [], []
+        with self.store._lock:
+            values = self.store.conn.execute(
+                "SELECT value FROM outputs WHERE job = ? ORDER BY rowid", [self.id]
+            )
+            for (value,) in values:
+                value = json.loads(value)
+                cards.extend(tuple(card) for card in value["cards"])
+                additional.extend(tuple(row) for row in value["additional"])
+                generated_nothing.extend(value["generated_nothing"])
+        return cards, additional, generated_nothing
+
+    def counts(self) -> dict:
+        with self.store._lock:
+            counts = self.store.conn.execute(
+                "SELECT status, COUNT(*) FROM rows WHERE job = ? GROUP BY status",
+                [self.id],
+            )
+            return dict(counts)
+
+    def record_done(self, result: StreamResult):
+        value = {
+            "cards": result.cards,
+            "additional": result.additional,
+            "generated_nothing": result.generated_nothing,
+        }
+        with self.store._lock, self.store.conn:
+            self.store.conn.execute(
+                "INSERT INTO outputs VALUES (?, ?)",
+                [self.id, json.dumps(value, ensure_ascii=False)],
+            )
+            self._set_status(result.rows, "done", None)
+
+    def record_failed(self, rows: List[Tuple[str, str]], error: str):
+        with self.store._lock, self.store.conn:
+            self._set_status(rows, "failed", error)
+
+    def _set_status(self, rows, status: str, error: str):
+        self.store.conn.executemany(
+            "INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?, ?)",
+            [(self.id, *row, status, error) for row in rows],
         )
 
-        cards = p.generate_cards()
-        cards_to_add.extend(cards)
-        # Examples, synonyms, antonyms, related words, etc
-        additional = p.get_additional_outputs()
-        additional_outputs.extend([(entry, out) for out in additional])
+    def finish_generating(self):
+        # Every row is done, so running the job again starts from scratch
+        with self.store._lock, self.store.conn:
+            for table in ["rows", "outputs"]:
+                self.store.conn.execute(f"DELETE FROM {table} WHERE job = ?", [self.id])
+
+    def finish_writing(self):
+        # Every note has been sent, so writing the cards again sends them all
+        with self.store._lock, self.store.conn:
+            self.store.conn.execute("DELETE FROM written WHERE job = ?", [self.id])
+
+    def written(self, notes: List[str]) -> set:
+        # Which of the notes (see note_key) this job has already written
+        with self.store._lock:
+            rows = select_in(
+                self.store.conn,
+                "SELECT note FROM written WHERE job = ? AND note IN",
+                [self.id],
+                notes,
+            )
+        return {note for (note,) in rows}
+
+    def record_written(self, notes: List[str]):
+        with self.store._lock, self.store.conn:
+            self.store.conn.executemany(
+                "INSERT OR IGNORE INTO written VALUES (?, ?)",
+                [(self.id, note) for note in notes],
+            )
+
 
-        if not cards and not additional:
-            generated_nothing.extend([entry])
+def note_key(row) -> str:
+    # Identifies a card by everything that ends up in its note, so a card
+    # that's been edited since it was written counts as a different one
+    return config_hash([str(row[column]) for column in CARD_COLUMNS])
 
-    return cards_to_add, additional_outputs, generated_nothing
+
+def run_all(executor: ThreadPoolExecutor, fn, items) -> list:
+    # Map fn over items, on the executor if there is one. Results are in the
+    # same order as the items either way.
+    if executor is None:
+        return [fn(item) for item in items]
+    return list(executor.map(fn, items))
+
+
+def token_tuples(doc) -> List[Tuple[str, str, str]]:
+    return [(token.lemma_, token.pos_, token.tag_) for token in doc]
+
+
+@metrics.timed("spacy.pipe")
+def lemmatise_phrases(
+    nlp: Language, phrases: List[str], batch_size=SPACY_BATCH_SIZE, n_process=1
+) -> List[List[Tuple[str, str, str]]]:
+    # Run every phrase through SpaCy in one go, which is much faster than
+    # calling the pipeline once per phrase. We only need lemmas and tags,
+    # so skip the components that don't produce them.
+    disable = [name for name in nlp.pipe_names if name in UNUSED_SPACY_PIPES]
+    docs = nlp.pipe(
+        phrases, batch_size=batch_size, n_process=n_process, disable=disable
+    )
+    return [token_tuples(doc) for doc in docs]
 
 
 def look_up_word(coll, word):
@@ -238,12 +1566,267 @@ def look_up_word(coll, word):
     )
 
 
+def look_up_words(
+    coll, words, chunk_size=MONGO_LOOKUP_CHUNK, executor: ThreadPoolExecutor = None
+) -> dict:
+    # Same as look_up_word, but for many words at once using a few $in queries.
+    # Returns the entries grouped by word.
+    words = list(dict.fromkeys(words))
+    entries_by_word = {word: [] for word in words}
+
+    def find_chunk(i):
+        with metrics.timer("mongo.find"):
+            entries = coll.find(
+                {
+                    "word": {"$in": words[i : i + chunk_size]},
+                    "senses.form_of": {"$exists": False},
+                },
+                {"_id": 0},
+            )
+            return list(entries)
+
+    for entries in run_all(executor, find_chunk, range(0, len(words), chunk_size)):
+        for entry in entries:
+            entries_by_word.setdefault(entry["word"], []).append(entry)
+
+    logging.info(f"Looked up {len(words)} distinct words")
+    metrics.count("mongo.words", len(words))
+    return entries_by_word
+
+
+def look_up_forms(
+    forms_coll,
+    forms,
+    chunk_size=MONGO_LOOKUP_CHUNK,
+    executor: ThreadPoolExecutor = None,
+) -> dict:
+    # Find the headwords each of the forms is a form of, in a collection
+    # built by build_forms_collection. Returns (headword, part of speech)
+    # pairs grouped by form, leaving out forms we know nothing about.
+    forms = list(dict.fromkeys(forms))
+
+    def find_chunk(i):
+        with metrics.timer("mongo.find_forms"):
+            documents = forms_coll.find(
+                {"form": {"$in": forms[i : i + chunk_size]}}, {"_id": 0}
+            )
+            return list(documents)
+
+    headwords_by_form = {}
+    for documents in run_all(executor, find_chunk, range(0, len(forms), chunk_size)):
+        for doc in documents:
+            pairs = headwords_by_form.setdefault(doc["form"], [])
+            if (doc["word"], doc["pos"]) not in pairs:
+                pairs.append((doc["word"], doc["pos"]))
+    return headwords_by_form
+
+
+def fill_in_from_forms(
+    forms_coll,
+    coll,
+    entries_by_word: dict,
+    anki_index=None,
+    executor: ThreadPoolExecutor = None,
+) -> set:
+    # SpaCy's lemma for a word is sometimes just the inflected form it was
+    # given, or a guess that isn't in Wiktionary. Give words like that the
+    # entries of the headwords they're forms of instead, so they still get
+    # cards. Headwords that are already in Anki are left out. Returns the
+    # words that were found in the forms collection.
+    missing = [word for word, entries in entries_by_word.items() if not entries]
+    if not missing:
+        return set()
+
+    headwords_by_form = look_up_forms(forms_coll, missing, executor=executor)
+    headwords = {
+        word
+        for pairs in headwords_by_form.values()
+        for word, _ in pairs
+        if anki_index is None or not anki_index.in_anki(word)
+    }
+    entries_by_headword = look_up_words(coll, headwords, executor=executor)
+
+    resolved = 0
+    for form, pairs in headwords_by_form.items():
+        entries_by_word[form] = [
+            entry
+            for word, pos in pairs
+            for entry in entries_by_headword.get(word, [])
+            if entry["pos"] == pos
+        ]
+        resolved += bool(entries_by_word[form])
+    metrics.count("forms.resolved", resolved)
+    return set(headwords_by_form)
+
+
+def ensure_indexes(coll):
+    # look_up_word and look_up_words query on the word field. We'd ideally use
+    # a partial index that leaves out form_of entries, but partial indexes
+    # can't express "$exists: false", so index every entry on word instead.
+    # Word is selective enough that filtering out form_of afterwards is cheap.
+    coll.create_index("word", name="word")
+    logging.info(f"Created indexes on {coll.full_name}")
+
+
+def uses_word_index(coll) -> bool:
+    # Ask Mongo how it would run a look_up_word query, and check that it would
+    # use an index rather than scanning the whole collection
+    plan = look_up_word(coll, "").explain()
+    stages = plan_stages(plan.get("queryPlanner", {}).get("winningPlan", {}))
+    return "IXSCAN" in stages and "COLLSCAN" not in stages
+
+
+def plan_stages(plan) -> List[str]:
+    # Collect every stage in a query plan. Plans are nested and their layout
+    # varies between Mongo versions, so just walk the whole thing.
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+    return stages
+
+
+def needed_fields(language_config: dict):
+    # Work out which top-level fields of an entry the language config's jq
+    # filters could read. This errs on the side of keeping fields: anything
+    # that looks like a field access anywhere in a filter is kept. Returns None
+    # if a filter could read fields we can't predict (e.g. with .. or keys).
+    fields = set(BUILTIN_FIELDS)
+    for pos_config in language_config.values():
+        for jq_filter in [pos_config["front"], pos_config["back"]]:
+            if re.search(r"\.\.|\bkeys|\bto_entries|\bpaths|\btostream", jq_filter):
+                return None
+            fields.update(re.findall(r"\.([A-Za-z_][A-Za-z0-9_]*)", jq_filter))
+            fields.update(re.findall(r'\.\[\s*"([^"]+)"\s*\]', jq_filter))
+    return fields
+
+
+def slim_entry(entry: dict, fields) -> dict:
+    # Cut an entry down to the fields we need, and strip stress marks from the
+    # word we look it up by
+    if fields is not None:
+        entry = {k: v for k, v in entry.items() if k in fields}
+    entry["word"] = strip_stress_marks(entry["word"])
+    return entry
+
+
+def build_slim_collection(source, dest, language_config: dict, batch_size=1000):
+    # Copy the entries we can generate cards from into a much smaller
+    # collection: form_of entries are dropped, and so is every field the
+    # language config doesn't read (etymology, translations, descendants...)
+    fields = needed_fields(language_config)
+    projection = {"_id": 0}
+    if fields is not None:
+        projection.update({field: 1 for field in fields})
+
+    dest.drop()
+    entries = source.find({"senses.form_of": {"$exists": False}}, projection)
+
+    count = 0
+    batch = []
+    for entry in entries:
+        batch.append(slim_entry(entry, fields))
+        if len(batch) >= batch_size:
+            dest.insert_many(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        dest.insert_many(batch)
+        count += len(batch)
+
+    ensure_indexes(dest)
+    logging.info(f"Wrote {count} entries to {dest.full_name}")
+    return count
+
+
+def form_documents(entry: dict) -> List[dict]:
+    # Map each surface form an entry tells us about to its headword: the rows
+    # of a headword's forms table, and the word itself for a form_of entry.
+    # Stress marks aren't stripped here, see build_forms_collection.
+    word = entry["word"]
+    pos = entry.get("pos", "")
+    documents = [
+        {"form": word, "word": form_of["word"], "pos": pos}
+        for sense in entry.get("senses", [])
+        for form_of in sense.get("form_of", [])
+        if "word" in form_of
+    ]
+    for form in entry.get("forms", []):
+        text = form.get("form", "")
+        # Multi-word forms (like the compound future) can't match a single
+        # SpaCy token, so there's no point keeping them
+        if not text or text == "-" or " " in text:
+            continue
+        if FORM_TAGS_TO_SKIP.intersection(form.get("tags", [])):
+            continue
+        documents.append({"form": text, "word": word, "pos": pos})
+    return documents
+
+
+def build_forms_collection(source, dest, batch_size=1000):
+    # Build a collection mapping every inflected form in the Wiktionary export
+    # to the headwords and parts of speech it's a form of. Needs the full
+    # collection, as slim collections leave out form_of entries.
+    dest.drop()
+    projection = {
+        "_id": 0,
+        "word": 1,
+        "pos": 1,
+        "forms.form": 1,
+        "forms.tags": 1,
+        "senses.form_of.word": 1,
+    }
+
+    count = 0
+    batch = []
+
+    def write_batch():
+        # Strip stress marks from the whole batch at once, then drop anything
+        # that turns out to be the same form of the same word
+        forms = strip_stress_marks_all([doc["form"] for doc in batch])
+        words = strip_stress_marks_all([doc["word"] for doc in batch])
+        unique = dict.fromkeys(
+            (form, word, doc["pos"])
+            for form, word, doc in zip(forms, words, batch)
+            if form != word
+        )
+        if unique:
+            dest.insert_many(
+                [{"form": f, "word": w, "pos": pos} for f, w, pos in unique]
+            )
+        return len(unique)
+
+    for entry in source.find({}, projection):
+        if "word" not in entry:
+            continue
+        batch.extend(form_documents(entry))
+        if len(batch) >= batch_size:
+            count += write_batch()
+            batch = []
+    if batch:
+        count += write_batch()
+
+    dest.create_index("form", name="form")
+    logging.info(f"Wrote {count} forms to {dest.full_name}")
+    return count
+
+
+@metrics.timed("jq.retrieve_fields")
 def retrieve_fields(entry, fields):
     try:
-        res = jq.compile(fields).input_value(entry).all()
+        res = jq_cache.get(fields).input_value(entry).all()
     except ValueError:
         return []
 
+    return clean_results(res)
+
+
+def clean_results(res):
     if not res:
         return []
 
@@ -253,58 +1836,437 @@ def retrieve_fields(entry, fields):
     return [e for e in res if e]
 
 
-def strip_stress_marks(text: str) -> str:
-    # https://www.ojisanseiuchi.com/2022/01/23/stripping-russian-syllabic-stress-marks-in-python/
-    b = text.encode("utf-8")
+@lru_cache(maxsize=None)
+def build_combined_filter(front: str, back: str) -> str:
+    # Build a single jq program which emits every field for a card as one object,
+    # so each entry only goes through jq once. Every filter gets its own
+    # try/catch so a failing filter only empties its own field, the same as
+    # running it on its own through retrieve_fields.
+    filters = {
+        "front": front,
+        "back": back,
+        "base": BASE_FILTER,
+        "audio": AUDIO_FILTER,
+        "examples": EXAMPLES_FILTER,
+        "related": RELATED_FILTER,
+        "also_related": ALSO_RELATED_FILTER,
+    }
+    return (
+        "{"
+        + ", ".join(f"{k}: (try [({v})] catch [])" for k, v in filters.items())
+        + "}"
+    )
+
+
+@metrics.timed("jq.extract_entry_fields")
+def extract_entry_fields(entry, config, single_pass: bool = True) -> EntryFields:
+    if single_pass:
+        try:
+            combined = build_combined_filter(config["front"], config["back"])
+            res = jq_cache.get(combined).input_value(entry).first()
+        except ValueError:
+            # Usually means one of the configured filters doesn't compile;
+            # fall back to running them one by one so the others still work
+            res = None
+
+        if res is not None:
+            audio = clean_results(res["audio"])
+            return EntryFields(
+                front=clean_results(res["front"]),
+                back=clean_results(res["back"]),
+                base=clean_results(res["base"]),
+                audio=audio[0] if audio else "",
+                examples=clean_results(res["examples"]),
+                related=clean_results(res["related"])
+                + clean_results(res["also_related"]),
+            )
+
+    return EntryFields(
+        front=retrieve_fields(entry, config["front"]),
+        back=retrieve_fields(entry, config["back"]),
+        base=retrieve_fields(entry, BASE_FILTER),
+        audio=get_audio(entry),
+        examples=retrieve_fields(entry, EXAMPLES_FILTER),
+        related=retrieve_fields(entry, RELATED_FILTER)
+        + retrieve_fields(entry, ALSO_RELATED_FILTER),
+    )
+
+
+# https://www.ojisanseiuchi.com/2022/01/23/stripping-russian-syllabic-stress-marks-in-python/
+# str.replace on each of these in turn is faster than str.translate or a regex,
+# as well as encoding to UTF-8 and back
+STRESS_MARK_REPLACEMENTS = [
+    # remove combining diacritical mark
+    ("\u0301", ""),
     # correct error where latin accented ó is used
-    b = b.replace(b"\xc3\xb3", b"\xd0\xbe")
+    ("\u00f3", "\u043e"),
     # correct error where latin accented á is used
-    b = b.replace(b"\xc3\xa1", b"\xd0\xb0")
-    # correct error where latin accented é is used
-    b = b.replace(b"\xc3\xa0", b"\xd0\xb5")
+    ("\u00e1", "\u0430"),
+    # correct error where latin accented à is used
+    ("\u00e0", "\u0435"),
     # correct error where latin accented ý is used
-    b = b.replace(b"\xc3\xbd", b"\xd1\x83")
-    # remove combining diacritical mark
-    b = b.replace(b"\xcc\x81", b"").decode()
-    return b
+    ("\u00fd", "\u0443"),
+]
 
 
-def call_ankiconnect(request):
-    request_json = json.dumps(request).encode("utf-8")
-    response = json.load(
-        urllib.request.urlopen(
-            urllib.request.Request("http://127.0.0.1:8765", request_json)
+def strip_stress_marks(text: str) -> str:
+    for old, new in STRESS_MARK_REPLACEMENTS:
+        text = text.replace(old, new)
+    return text
+
+
+def strip_stress_marks_all(texts):
+    # strip_stress_marks for a whole list or pandas Series of strings. Joining
+    # them up and making one pass over the lot is several times faster than
+    # going through them one by one.
+    # Only look for a Series if pandas is loaded, since nothing else could
+    # have made one
+    pd = sys.modules.get("pandas")
+    if pd is not None and isinstance(texts, pd.Series):
+        if texts.isna().any():
+            return texts.map(strip_stress_marks, na_action="ignore")
+        return pd.Series(
+            strip_stress_marks_all(texts.tolist()),
+            index=texts.index,
+            name=texts.name,
+            dtype=texts.dtype,
         )
-    )
+
+    texts = list(texts)
+    joined = "\0".join(texts)
+    if not texts or joined.count("\0") != len(texts) - 1:
+        # Can't split the texts back up if any contain the separator
+        return [strip_stress_marks(text) for text in texts]
+    return strip_stress_marks(joined).split("\0")
+
+
+class AnkiConnectError(Exception):
+    # AnkiConnect couldn't be reached, or sent back something that isn't an
+    # AnkiConnect response. Errors from the actions themselves (duplicate
+    # notes and so on) are returned in the response's "error" field instead.
+    pass
+
+
+def check_ankiconnect_response(response):
     # Error handling borrowed from https://git.foosoft.net/alex/anki-connect#python
     if len(response) != 2:
-        raise Exception("Response has an unexpected number of fields")
+        raise AnkiConnectError("Response has an unexpected number of fields")
     if "error" not in response:
-        raise Exception("Response is missing required error field")
+        raise AnkiConnectError("Response is missing required error field")
     if "result" not in response:
-        raise Exception("Response is missing required result field")
+        raise AnkiConnectError("Response is missing required result field")
     if response["error"] is not None:
-        msg = f"Calling Ankiconnect returned errors: {response['error']}"
-        # Write to both terminal and streamlit
-        print(msg)
-        st.write(msg)
+        logging.warning(f"Calling Ankiconnect returned errors: {response['error']}")
 
     return response
 
 
-def write_df_to_anki(df, deck, card_type):
-    errors = []
+class AnkiConnect:
+    # Client for AnkiConnect which keeps a pool of keep-alive connections, so
+    # it can be shared between threads without opening a new connection for
+    # every request. Requests it can't get through are retried with backoff.
+    #
+    # AnkiConnect closes each connection after answering without saying so, so
+    # connections are only pooled if the answer promised to keep them open.
+    # Should a pooled connection still turn out to be dead, a request that
+    # fails on it before Anki could have seen it is sent again on a new
+    # connection straight away. Once Anki might have seen a request it's
+    # never sent again, as that could add the same notes twice.
+    def __init__(
+        self,
+        host: str = ANKICONNECT_HOST,
+        port: int = ANKICONNECT_PORT,
+        timeout: float = ANKICONNECT_TIMEOUT,
+        retries: int = ANKICONNECT_RETRIES,
+        backoff: float = ANKICONNECT_BACKOFF,
+        pool_size: int = CONCURRENCY_LIMITS["ankiconnect"],
+    ):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # Idle connections, most recently used first
+        self._pool = queue.LifoQueue(pool_size)
+
+    def _connection(
+        self, reuse: bool = True
+    ) -> Tuple[http.client.HTTPConnection, bool]:
+        # An idle connection Anki hasn't closed yet if there is one, otherwise
+        # a new one, along with whether it was reused
+        while reuse:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            # An idle connection only has something to read if Anki closed it
+            if conn.sock is not None and not select.select([conn.sock], [], [], 0)[0]:
+                return conn, True
+            conn.close()
+        return (
+            http.client.HTTPConnection(self.host, self.port, timeout=self.timeout),
+            False,
+        )
+
+    def _release(self, conn: http.client.HTTPConnection):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def call(self, request):
+        request_json = json.dumps(request).encode("utf-8")
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+
+        attempt = 0
+        reuse = True
+        while True:
+            conn, reused = self._connection(reuse)
+            sent = False
+            try:
+                with metrics.timer(f"ankiconnect.{request['action']}"):
+                    conn.request("POST", "/", request_json, headers)
+                    sent = True
+                    answer = conn.getresponse()
+                    response = json.load(answer)
+            except TimeoutError as e:
+                # Anki may still be working through the request, so sending it
+                # again could add the same notes twice
+                conn.close()
+                raise AnkiConnectError(
+                    f"AnkiConnect didn't answer within {self.timeout}s"
+                ) from e
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                # Anki closed this connection while it sat in the pool, and
+                # never got the request
+                if reused and not sent:
+                    reuse = False
+                    continue
+                if sent:
+                    raise AnkiConnectError(
+                        "Lost the connection to AnkiConnect while waiting for an "
+                        + "answer, so the request may or may not have gone through"
+                    ) from e
+                if attempt == self.retries:
+                    raise AnkiConnectError(
+                        f"Couldn't reach AnkiConnect at {self.host}:{self.port}, "
+                        + "is Anki running?"
+                    ) from e
+                metrics.count("ankiconnect.retries")
+                time.sleep(self.backoff * 2**attempt)
+                attempt += 1
+            except ValueError as e:
+                conn.close()
+                raise AnkiConnectError("AnkiConnect didn't send back JSON") from e
+            else:
+                keep_alive = answer.getheader("Connection", "").lower() == "keep-alive"
+                if keep_alive and not answer.will_close:
+                    self._release(conn)
+                else:
+                    conn.close()
+                return check_ankiconnect_response(response)
+
+    def multi(self, actions: List[dict]) -> List[dict]:
+        # Run several actions in one request. Returns one {"result", "error"}
+        # response per action, in the same order as the actions.
+        actions = [{"version": 6, **action} for action in actions]
+        request = {
+            "action": "multi",
+            "version": 6,
+            "params": {"actions": actions},
+        }
+        response = self.call(request)
+        if response["error"] is not None:
+            # The whole request failed, so every action in it failed
+            return [{"result": None, "error": response["error"]} for _ in actions]
+        return response["result"]
+
+    def pipeline(self, batch_size: int = ANKI_WRITE_BATCH_SIZE) -> AnkiPipeline:
+        return AnkiPipeline(self, batch_size)
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AnkiPipeline:
+    # Queues up actions and sends them batch_size at a time as multi requests,
+    # in the order they were queued. Each action gets a Future for its
+    # {"result", "error"} response, which is set once its batch has been sent.
+    # Not thread-safe, so use one per thread.
+    def __init__(self, client: AnkiConnect, batch_size: int = ANKI_WRITE_BATCH_SIZE):
+        self.client = client
+        self.batch_size = batch_size
+        self._queued = []
+
+    def submit(self, action: dict) -> Future:
+        future = Future()
+        self._queued.append((action, future))
+        if len(self._queued) >= self.batch_size:
+            self.flush()
+        return future
+
+    def flush(self):
+        queued, self._queued = self._queued, []
+        if not queued:
+            return
+        try:
+            results = self.client.multi([action for action, _ in queued])
+        except AnkiConnectError as e:
+            for _, future in queued:
+                future.set_exception(e)
+            raise
+        for (_, future), result in zip(queued, results):
+            future.set_result(result)
+
+    def __len__(self):
+        # Number of actions waiting to be sent
+        return len(self._queued)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        # Send whatever's left, unless we're leaving because of an error
+        if exc_type is None:
+            self.flush()
+
+
+# Shared by everything that talks to AnkiConnect
+ankiconnect = AnkiConnect()
+
+
+@metrics.timed("stage.write_to_anki")
+def write_df_to_anki(
+    df,
+    deck,
+    card_type,
+    anki_index=None,
+    batch_size=ANKI_WRITE_BATCH_SIZE,
+    bar=None,
+    audio_cache=None,
+    job: ImportJob = None,
+):
+    # Send the notes to AnkiConnect in batches, one addNote action per note
+    # inside multi requests so each error can be matched back to its row.
+    # With a job, notes it has already written are skipped. Call
+    # job.finish_writing once all of the job's cards have been sent.
+    if job is not None:
+        keys = [note_key(row) for _, row in df.iterrows()]
+        written = job.written(keys)
+        if written:
+            logging.info(f"Skipping {len(written)} notes already written")
+            metrics.count("anki.notes_skipped", len(written))
+            df = df[[key not in written for key in keys]]
+            keys = [key for key in keys if key not in written]
+
+    audio_files = {}
+    if audio_cache is not None:
+        # Download every recording up front, several at a time, rather than
+        # leaving Anki to fetch them one after another as it adds each note
+        audio_files = audio_cache.prefetch(df["Audio link"])
+
+    notes = [build_note(deck, card_type, row, audio_files) for _, row in df.iterrows()]
+    base_forms = list(df["Base form"])
+    added = []
+    stored = {}
+
+    try:
+        with ankiconnect.pipeline(batch_size) as pipe:
+            for i, note in enumerate(notes):
+                # Put any cached recording the note uses into Anki's media folder
+                # before the note that plays it
+                path = note.pop("audio_path", None)
+                if path is not None and path not in stored:
+                    stored[path] = pipe.submit(store_media_action(path))
+                added.append(
+                    pipe.submit({"action": "addNote", "params": {"note": note}})
+                )
+
+                if bar is not None and not len(pipe):
+                    # A batch has just gone off
+                    bar.progress(min(1, (i + 1) / len(notes)))
+    finally:
+        if job is not None:
+            # Record whatever made it, even if Anki went away part way through
+            job.record_written(
+                [key for key, future in zip(keys, added) if in_anki(future)]
+            )
+
+    for path, future in stored.items():
+        if future.result()["error"]:
+            logging.warning(f"Could not store {path}: {future.result()['error']}")
+
+    errors = [
+        (base, future.result()["error"])
+        for base, future in zip(base_forms, added)
+        if future.result()["error"]
+    ]
+
+    logging.info(
+        f"Wrote {len(notes) - len(errors)} of {len(notes)} notes to {deck}, "
+        + f"{len(errors)} errors"
+    )
+    metrics.count("anki.notes_written", len(notes) - len(errors))
+    metrics.count("anki.write_errors", len(errors))
+
+    # Keep the index in step with the deck, so writing a chunk at a time
+    # doesn't mean reloading it for every chunk
+    if anki_index is not None:
+        anki_index.add_written(
+            [base for base, future in zip(base_forms, added) if in_anki(future)]
+        )
 
-    for _, row in df.iterrows():
-        st.write(f"Writing {row['Base form']}")
-        response = write_card(deck, card_type, row)
-        if response["error"]:
-            st.write(f"Error with {row['Base form']}, {response['error']}")
-            errors.append((row["Base form"], response["error"]))
     return errors
 
 
-def write_card(deck, card_type, row):
+def in_anki(future: Future) -> bool:
+    # Whether a queued addNote action has been sent and its note is now in
+    # Anki. Notes Anki turned down as duplicates count, as they'd only be
+    # turned down again.
+    if not future.done() or future.exception() is not None:
+        return False
+    error = future.result()["error"]
+    return not error or ANKI_DUPLICATE_ERROR in error
+
+
+def write_card(deck, card_type, row, audio_cache=None):
+    audio_files = {}
+    if audio_cache is not None and row["Audio link"]:
+        audio_files = audio_cache.prefetch([row["Audio link"]])
+
+    note = build_note(deck, card_type, row, audio_files)
+    path = note.pop("audio_path", None)
+    actions = [store_media_action(path)] if path is not None else []
+    actions.append({"action": "addNote", "params": {"note": note}})
+
+    # Store the recording and add the note in one go
+    return ankiconnect.multi(actions)[-1]
+
+
+def store_media_action(path: str) -> dict:
+    # Copy a file from the audio cache into Anki's media folder. AnkiConnect
+    # reads it straight from disk, as Anki runs on this machine.
+    return {
+        "action": "storeMediaFile",
+        "params": {"filename": os.path.basename(path), "path": os.path.abspath(path)},
+    }
+
+
+def build_note(deck, card_type, row, audio_files: dict = None):
+    # audio_files maps audio links to recordings in the audio cache. Notes
+    # using one of those have the recording's path under an extra
+    # "audio_path" key, which needs removing before the note goes to Anki.
     card = {
         "deckName": deck,
         "modelName": card_type,
@@ -317,7 +2279,11 @@ def write_card(deck, card_type, row):
         "options": {"allowDuplicate": False},
     }
 
-    if row["Audio link"]:
+    if audio_files and audio_files.get(row["Audio link"]):
+        path = audio_files[row["Audio link"]]
+        card["fields"]["Audio"] = f"[sound:{os.path.basename(path)}]"
+        card["audio_path"] = path
+    elif row["Audio link"]:
         card["audio"] = [
             {
                 "url": row["Audio link"],
@@ -326,18 +2292,191 @@ def write_card(deck, card_type, row):
             }
         ]
 
-    request = {
-        "action": "addNote",
-        "version": 6,
-        "params": {"note": card},
-    }
+    return card
+
 
-    return call_ankiconnect(request)
+def fetch_audio(url: str) -> bytes:
+    # Escape any non-ASCII characters (e.g. Cyrillic file names), leaving
+    # anything that's already escaped alone
+    url = urllib.parse.quote(url, safe=":/?&=%#+")
+    request = urllib.request.Request(url, headers={"User-Agent": AUDIO_USER_AGENT})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return response.read()
+
+
+class AudioCache:
+    # Local copies of the recordings linked from cards, so each one is only
+    # downloaded once however many cards, decks or runs use it. Files are
+    # named by the sha256 of their contents, and an index maps each URL to its
+    # file. `fetch` takes a URL and returns the file's contents; it can be
+    # swapped out, e.g. for one reading from a local file server in testing.
+    def __init__(
+        self,
+        cache_dir: str,
+        fetch=fetch_audio,
+        workers: int = AUDIO_PREFETCH_WORKERS,
+    ):
+        self.cache_dir = cache_dir
+        self.fetch = fetch
+        self.workers = workers
+        os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(
+            os.path.join(cache_dir, "index.sqlite"), check_same_thread=False
+        )
+        self._lock = threading.Lock()
+        with self._lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, filename TEXT)"
+            )
+
+    def prefetch(self, urls) -> dict:
+        # Make sure every URL is in the cache, downloading the missing ones in
+        # parallel. Returns a dict of URL -> local path, leaving out any which
+        # couldn't be downloaded.
+        urls = [url for url in dict.fromkeys(urls) if url]
+        paths = self._lookup(urls)
+        missing = [url for url in urls if url not in paths]
+        metrics.count("audio.cache_hits", len(paths))
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            for url, path in zip(missing, executor.map(self._download, missing)):
+                if path is not None:
+                    paths[url] = path
+
+        logging.info(
+            f"Audio cache: {len(urls) - len(missing)} of {len(urls)} cached, "
+            + f"{len(paths) - len(urls) + len(missing)} downloaded"
+        )
+        return paths
+
+    def path(self, filename: str) -> str:
+        # Spread files across subdirectories so none gets too big
+        return os.path.join(self.cache_dir, filename[:2], filename)
+
+    def _lookup(self, urls: List[str]) -> dict:
+        with self._lock:
+            rows = select_in(
+                self.conn, "SELECT url, filename FROM urls WHERE url IN", [], urls
+            )
+        found = {url: self.path(filename) for url, filename in rows}
+        # Ignore anything deleted from the cache directory since
+        return {url: path for url, path in found.items() if os.path.exists(path)}
+
+    def _download(self, url: str):
+        try:
+            with metrics.timer("audio.fetch"):
+                data = self.fetch(url)
+        except Exception as e:
+            logging.warning(f"Could not download {url}: {e}")
+            return None
+
+        extension = os.path.splitext(urllib.parse.urlparse(url).path)[1] or ".mp3"
+        filename = hashlib.sha256(data).hexdigest() + extension
+        path = self.path(filename)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename, so an interruption can't leave a partial file
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO urls VALUES (?, ?)", (url, filename)
+            )
+        return path
 
 
 class TestTranslator:
-    def translate_text(*args, **kwargs):
-        return "Test translation"
+    # Stands in for deepl.Translator so testing doesn't use up DeepL characters
+    # Don't save its translations to the translation memory
+    persist_results = False
+
+    def translate_text(self, text, **kwargs):
+        # Like DeepL, translate either a single string or a list of them
+        if isinstance(text, str):
+            return "Test translation"
+        return ["Test translation" for _ in text]
+
+
+class TranslationMemory:
+    # Every translation we've had back from DeepL, so re-importing a phrase
+    # doesn't cost another request (and more DeepL characters)
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS translations (source TEXT, target_lang "
+                + "TEXT, translation TEXT, PRIMARY KEY (source, target_lang))"
+            )
+
+    def get(self, sources: List[str], target_lang: str = TARGET_LANG) -> dict:
+        with self._lock:
+            rows = select_in(
+                self.conn,
+                "SELECT source, translation FROM translations WHERE target_lang = ? "
+                + "AND source IN",
+                [target_lang],
+                sources,
+            )
+        return dict(rows)
+
+    def put(self, translations: dict, target_lang: str = TARGET_LANG):
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO translations VALUES (?, ?, ?)",
+                [(k, target_lang, v) for k, v in translations.items()],
+            )
+
+
+def normalise_source(text: str) -> str:
+    return " ".join(strip_stress_marks(text).split())
+
+
+@metrics.timed("stage.translate")
+def translate_phrases(
+    translator,
+    phrases: List[str],
+    memory: TranslationMemory = None,
+    target_lang: str = TARGET_LANG,
+    batch_size: int = DEEPL_BATCH_SIZE,
+    executor: ThreadPoolExecutor = None,
+) -> dict:
+    # Translate a list of phrases, returning a dict of phrase -> translation.
+    # Each distinct phrase is only translated once, the translation memory is
+    # checked first, and the rest go to DeepL several at a time.
+    sources = {phrase: normalise_source(phrase) for phrase in phrases}
+    unique_sources = list(dict.fromkeys(sources.values()))
+
+    translations = memory.get(unique_sources, target_lang) if memory else {}
+    missing = [source for source in unique_sources if source not in translations]
+
+    def translate_batch(i):
+        batch = missing[i : i + batch_size]
+        with metrics.timer("deepl.translate"):
+            results = translator.translate_text(batch, target_lang=target_lang)
+        metrics.count("deepl.characters", sum(len(source) for source in batch))
+        return zip(batch, results)
+
+    new_translations = {}
+    batches = range(0, len(missing), batch_size)
+    for results in run_all(executor, translate_batch, batches):
+        for source, result in results:
+            new_translations[source] = getattr(result, "text", result)
+
+    logging.info(
+        f"Translating {len(unique_sources)} phrases, "
+        + f"{len(unique_sources) - len(missing)} from translation memory"
+    )
+    metrics.count("translation_memory.hits", len(unique_sources) - len(missing))
+
+    if memory is not None and getattr(translator, "persist_results", True):
+        memory.put(new_translations, target_lang)
+
+    translations.update(new_translations)
+    return {phrase: translations[source] for phrase, source in sources.items()}
 
 
 def create_card_from_contents(front_contents, back_contents, base, pos, audio_link):
@@ -347,8 +2486,14 @@ def create_card_from_contents(front_contents, back_contents, base, pos, audio_li
     return Card(front, back, pos, base, audio_link)
 
 
+def create_card_from_fields(fields: EntryFields, pos):
+    return create_card_from_contents(
+        fields.front, fields.back, fields.base, pos, fields.audio
+    )
+
+
 def get_audio(entry):
-    audio = retrieve_fields(entry, '.sounds[] | select(.text == "Audio") | .mp3_url')
+    audio = retrieve_fields(entry, AUDIO_FILTER)
     if audio:
         # Pull just the first sound entry
         audio_link = audio[0]
@@ -0,0 +1,339 @@
+import hashlib
+import json
+import re
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append("..")
+
+from ankifier.utils import fetch_audio, form_documents, strip_stress_marks
+
+# Stand-ins for Mongo, AnkiConnect and SpaCy so the benchmarks run offline
+# and give the same results every time. DeepL is replaced by TestTranslator.
+
+POS_WEIGHTS = {"noun": 5, "verb": 3, "adj": 2}
+SYLLABLES = [
+    c + v for c in "бвгдзклмнпрстхчш" for v in ["а", "о", "у", "и", "е", "я", "ы"]
+]
+GLOSSES = ["house", "water", "to run", "quick", "to read", "tree", "bright", "city"]
+
+
+class FakeCollection:
+    # Read-only, in-memory replacement for a pymongo collection, indexed on
+    # "word" (or "form" for a forms collection) like the real one. Only
+    # supports the queries Ankifier makes when generating cards.
+    def __init__(self, entries, name="benchmark", key="word"):
+        self.full_name = f"fake.{name}"
+        self.key = key
+        self.by_word = {}
+        for entry in entries:
+            self.by_word.setdefault(entry[key], []).append(entry)
+
+    def find(self, query, projection=None):
+        words = query[self.key]
+        if isinstance(words, dict):
+            words = words["$in"]
+        else:
+            words = [words]
+
+        skip_forms = "senses.form_of" in query
+        for word in words:
+            for entry in self.by_word.get(word, []):
+                if skip_forms and any("form_of" in s for s in entry["senses"]):
+                    continue
+                # Mongo hands back a fresh document each time
+                yield {k: v for k, v in entry.items() if k != "_id"}
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+
+class FakeToken:
+    def __init__(self, text):
+        self.lemma_ = text.lower()
+        self.pos_ = "NOUN"
+        self.tag_ = "NN"
+
+
+class FakeNLP:
+    # Splits on whitespace and uses each lowercased word as its own lemma
+    pipe_names = ["tok2vec", "morphologizer", "parser", "lemmatizer", "ner"]
+
+    def __call__(self, text):
+        return [FakeToken(word) for word in text.split()]
+
+    def pipe(self, texts, **kwargs):
+        for text in texts:
+            yield self(text)
+
+
+class FakeAnki:
+    # Keeps notes in memory and answers the AnkiConnect actions Ankifier uses.
+    # Like Anki, it downloads any audio URLs on a note (taking audio_latency
+    # seconds each) before answering.
+    def __init__(self, latency=0.0, audio_latency=0.0):
+        self.latency = latency
+        self.audio_latency = audio_latency
+        self.notes = []
+        self.fronts = set()
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.notes = []
+            self.fronts = set()
+            self.requests = 0
+
+    def handle(self, request):
+        action = request["action"]
+        params = request.get("params", {})
+
+        if action == "multi":
+            results = []
+            for action in params["actions"]:
+                try:
+                    results.append({"result": self.handle(action), "error": None})
+                except ValueError as e:
+                    results.append({"result": None, "error": str(e)})
+            return results
+
+        if action in ["findNotes", "findCards"]:
+            # Card ids are the same as note ids, as each note has one card
+            query = params["query"]
+            return [i for i, note in enumerate(self.notes) if self.matches(note, query)]
+        if action == "notesInfo":
+            return [
+                {
+                    "noteId": i,
+                    "fields": {
+                        name: {"value": value, "order": order}
+                        for order, (name, value) in enumerate(
+                            self.notes[i]["fields"].items()
+                        )
+                    },
+                }
+                for i in params["notes"]
+            ]
+        if action == "addNote":
+            note = params["note"]
+            time.sleep(self.audio_latency * len(note.get("audio", [])))
+            front = note["fields"]["Front"]
+            with self.lock:
+                # Anki checks the first field for duplicates
+                if front in self.fronts:
+                    raise ValueError("cannot create note because it is a duplicate")
+                self.fronts.add(front)
+                self.notes.append(note)
+                return len(self.notes) - 1
+        if action == "updateNote":
+            note = params["note"]
+            time.sleep(self.audio_latency * len(note.get("audio", [])))
+            self.notes[note["id"]]["fields"].update(note["fields"])
+            return None
+        if action == "storeMediaFile":
+            return params["filename"]
+        raise ValueError(f"unsupported action {action}")
+
+    def matches(self, note, query):
+        # Understands the searches Ankifier makes: deck:X, "Field:value" and
+        # "Field:" for an empty field, each of which can be negated with "-".
+        # Anything else is an error rather than a guess.
+        for negated, term in re.findall(r'(-?)("[^"]*"|\S+)', query):
+            name, colon, value = term.strip('"').partition(":")
+            if not colon or "*" in value or "_" in value:
+                raise ValueError(f"FakeAnki can't search for {term}")
+            if name == "deck":
+                deck = note["deckName"]
+                found = deck == value or deck.startswith(value + "::")
+            else:
+                # Field names and values are matched ignoring case, like Anki
+                fields = {k.casefold(): v for k, v in note["fields"].items()}
+                field = fields.get(name.casefold())
+                found = field is not None and field.casefold() == value.casefold()
+            if found == bool(negated):
+                return False
+        return True
+
+
+def serve_anki(fake, host="127.0.0.1", port=8765):
+    # Run a fake AnkiConnect server in the background, waiting `latency`
+    # seconds before answering each request
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            length = int(self.headers["Content-Length"])
+            request = json.loads(self.rfile.read(length))
+            with fake.lock:
+                fake.requests += 1
+            time.sleep(fake.latency)
+
+            try:
+                response = {"result": fake.handle(request), "error": None}
+            except ValueError as e:
+                response = {"result": None, "error": str(e)}
+
+            body = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serve_audio(host="127.0.0.1", port=8766, latency=0.0):
+    # Stand-in for Wikimedia's file server, answering every path with some
+    # made-up audio after waiting `latency` seconds
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(latency)
+            body = hashlib.sha256(self.path.encode()).digest() * 512
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/mpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def local_fetcher(server):
+    # Fetcher for AudioCache which downloads from the fake file server instead
+    # of wherever the URL points
+    host, port = server.server_address
+
+    def fetch(url):
+        path = urllib.parse.urlparse(url).path
+        return fetch_audio(f"http://{host}:{port}{path}")
+
+    return fetch
+
+
+def make_words(count, rng):
+    words = set()
+    while len(words) < count:
+        words.add("".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))))
+    return sorted(words)
+
+
+def stressed(word, rng):
+    # Put a stress mark on one of the vowels, like Wiktionary's headwords
+    vowels = [i for i, c in enumerate(word) if c in "аоуиеяы"]
+    i = rng.choice(vowels)
+    return word[: i + 1] + "\u0301" + word[i + 1 :]
+
+
+def make_entry(word, pos, rng):
+    form = stressed(word, rng)
+    forms = [{"form": form, "tags": ["canonical"]}]
+    if pos == "noun":
+        forms += [
+            {"form": form + ending, "tags": tags, "source": "declension"}
+            for ending, tags in [
+                ("", ["nominative", "singular"]),
+                ("ы", ["nominative", "plural"]),
+                ("у", ["accusative", "singular"]),
+            ]
+        ]
+    elif pos == "verb":
+        forms += [
+            {"form": form[:-1] + ending, "tags": tags}
+            for ending, tags in [
+                ("ю", ["first-person", "present", "singular"]),
+                ("ешь", ["present", "second-person", "singular"]),
+                ("ют", ["plural", "present", "third-person"]),
+            ]
+        ]
+    else:
+        forms += [{"form": form + "й", "tags": ["masculine", "nominative"]}]
+
+    senses = []
+    for _ in range(rng.randint(1, 3)):
+        sense = {"glosses": [rng.choice(GLOSSES)]}
+        if rng.random() < 0.5:
+            sense["examples"] = [{"text": f"{word} {word}", "english": "example"}]
+        if rng.random() < 0.3:
+            sense["synonyms"] = [{"word": rng.choice(SYLLABLES) + word}]
+        senses.append(sense)
+
+    entry = {"word": word, "pos": pos, "forms": forms, "senses": senses}
+    if rng.random() < 0.5:
+        entry["sounds"] = [
+            {"text": "Audio", "mp3_url": f"https://example.com/{word}.mp3"}
+        ]
+    if rng.random() < 0.2:
+        entry["related"] = [{"word": word + "ка"}]
+    return entry
+
+
+def make_entries(words, rng):
+    # One or two entries per word, plus some inflected forms pointing back at
+    # their lemma, which lookups should skip
+    entries = []
+    for word in words:
+        pos = rng.choices(list(POS_WEIGHTS), weights=POS_WEIGHTS.values())[0]
+        entries.append(make_entry(word, pos, rng))
+        if rng.random() < 0.1:
+            entries.append(make_entry(word, "noun" if pos != "noun" else "verb", rng))
+        if rng.random() < 0.1:
+            entries.append(
+                {
+                    "word": word,
+                    "pos": pos,
+                    "senses": [{"form_of": [{"word": word}], "glosses": ["form"]}],
+                }
+            )
+    return entries
+
+
+def make_forms(entries):
+    # Forms collection documents for the entries, as build_forms_collection
+    # would make them
+    documents = []
+    for entry in entries:
+        for doc in form_documents(entry):
+            doc = {k: strip_stress_marks(v) for k, v in doc.items()}
+            if doc["form"] != doc["word"]:
+                documents.append(doc)
+    return documents
+
+
+def make_vocab(size, words, rng, unknown_share=0.05, forms=None):
+    # Vocab lines like a real import: mostly single words, some phrases, a few
+    # with a translation already given and a few words not in the dictionary.
+    # If forms are given, some words are inflected forms instead.
+    lines = []
+    for i in range(size):
+        roll = rng.random()
+        if roll < unknown_share:
+            line = f"неизвестно{i}"
+        elif forms and roll < 0.15:
+            line = rng.choice(forms)["form"]
+        elif roll < 0.7:
+            line = rng.choice(words)
+        else:
+            line = " ".join(rng.choices(words, k=rng.randint(2, 4)))
+        if rng.random() < 0.05:
+            line += " | given translation"
+        lines.append(line)
+    return lines
@@ -0,0 +1,88 @@
+import click
+import os
+import subprocess
+import sys
+
+# Modules that take a noticeable time to import, and that we only want loaded
+# once something actually needs them
+HEAVY_MODULES = ["deepl", "jq", "pandas", "pymongo", "spacy", "streamlit"]
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def measure(module):
+    # Import the module in a fresh interpreter with -X importtime, returning
+    # the total microseconds it took, the time taken by each of its own imports
+    # and the heavy modules that ended up loaded
+    loaded = f"[m for m in {HEAVY_MODULES} if m in sys.modules]"
+    code = f"import sys, {module}; print(*{loaded})"
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    # Lines look like "import time: self [us] | cumulative | imported package",
+    # with nested imports indented two spaces per level and listed before the
+    # module that imported them
+    took = 0
+    children = {}
+    imports = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        if depth == 1:
+            children[name] = int(cumulative)
+        elif depth == 0:
+            if name == module:
+                took = int(cumulative)
+                imports = children
+            children = {}
+    return took, imports, process.stdout.split()
+
+
+@click.command()
+@click.option(
+    "--module",
+    "modules",
+    multiple=True,
+    default=["ankifier.utils", "ankifier.__main__"],
+    help="Module to time importing, can be given more than once",
+)
+@click.option("--repeat", default=5, help="Runs of each, the fastest is reported")
+@click.option("--top", default=5, help="Slowest of each module's imports to show")
+@click.option("--max-ms", type=float, help="Fail if any module takes longer than this")
+def main(modules: list, repeat: int, top: int, max_ms: float):
+    # Time how long it takes to import each module from scratch, e.g. before
+    # the app's first paint or before a data script starts working
+    too_slow = []
+    for module in modules:
+        # The first run also compiles any changed modules, so take the fastest
+        took, imports, heavy = min(
+            (measure(module) for _ in range(repeat)), key=lambda run: run[0]
+        )
+        took /= 1000
+
+        click.echo(f"{module}: {took:.1f}ms")
+        slowest = sorted(imports.items(), key=lambda item: item[1], reverse=True)
+        for name, cumulative in slowest[:top]:
+            click.echo(f"    {name:30} {cumulative / 1000:.1f}ms")
+        if heavy:
+            click.echo(f"    loaded {', '.join(heavy)}")
+
+        if max_ms is not None and took > max_ms:
+            too_slow.append(module)
+
+    if too_slow:
+        raise click.ClickException(
+            f"Took longer than {max_ms}ms to import: {', '.join(too_slow)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
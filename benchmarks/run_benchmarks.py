@@ -0,0 +1,251 @@
+import click
+import io
+import json
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import yaml
+
+sys.path.append("..")
+
+from ankifier import utils
+from fakes import (
+    FakeAnki,
+    FakeCollection,
+    FakeNLP,
+    local_fetcher,
+    make_entries,
+    make_forms,
+    make_vocab,
+    make_words,
+    serve_anki,
+    serve_audio,
+)
+
+DECK = "Benchmark"
+CARD_TYPE = "Russian"
+
+
+def load_sample(path):
+    # Entries from a Kaikki JSONL file, e.g. the first few thousand lines of a
+    # real export, cleaned the same way import_kaikki.py does
+    entries = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                entry["word"] = utils.strip_stress_marks(entry["word"])
+                entries.append(entry)
+    return entries
+
+
+def timed(times, stage, fn, *args, **kwargs):
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    times[stage] = time.perf_counter() - started
+    return result
+
+
+def run_size(lines, context, fake, batch_size, write, memory, audio_cache=None):
+    utils.jq_cache.clear()
+    fake.reset()
+    times = {}
+
+    # Each stage on its own, run one after the other
+    chunks = timed(times, "read", lambda: list(utils.read_vocab(io.StringIO(lines))))
+    rows = list(dict.fromkeys(row for chunk in chunks for row in chunk))
+    cleaned = list(dict.fromkeys(utils.strip_stress_marks(p) for p, _ in rows))
+
+    tokens = timed(times, "lemmatise", utils.lemmatise_phrases, context.nlp, cleaned)
+    lemmas = list(dict.fromkeys(t[0] for phrase in tokens for t in phrase))
+    entries = timed(times, "look_up", utils.look_up_words, context.coll, lemmas)
+
+    def generate_words():
+        for lemma in lemmas:
+            word = utils.Word(
+                lemma, "", context.language_config, context.coll, context.single_pass
+            )
+            word.generate_cards(entries[lemma])
+
+    timed(times, "generate_words", generate_words)
+    phrases = [p for p, t in zip(cleaned, tokens) if len(t) > 1]
+    timed(times, "translate", utils.translate_phrases, context.translator, phrases)
+    timed(times, "anki_index", utils.AnkiIndex(DECK).load)
+
+    # Then everything together, the way an import runs
+    collector = timed(
+        times,
+        "end_to_end",
+        utils.generate_cards_for_rows,
+        rows,
+        context,
+        utils.AnkiIndex(DECK),
+    )
+    cards, _, _ = collector.frames()
+
+    peak = None
+    if memory:
+        # tracemalloc slows everything down, so measure memory on its own run
+        utils.jq_cache.clear()
+        tracemalloc.start()
+        utils.generate_cards_for_rows(rows, context, utils.AnkiIndex(DECK))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    if write:
+        requests_before = fake.requests
+        timed(
+            times,
+            "write",
+            utils.write_df_to_anki,
+            cards,
+            DECK,
+            CARD_TYPE,
+            batch_size=batch_size,
+            audio_cache=audio_cache,
+        )
+        write_requests = fake.requests - requests_before
+
+    result = {
+        "lines": sum(len(chunk) for chunk in chunks),
+        "rows": len(rows),
+        "lemmas": len(lemmas),
+        "cards": len(cards),
+        "rows_per_second": len(rows) / times["end_to_end"],
+        "peak_memory_mb": peak / 1e6 if peak is not None else None,
+        "seconds": times,
+    }
+    if write:
+        result["write_requests"] = write_requests
+    return result
+
+
+def print_result(result):
+    seconds = result["seconds"]
+    click.echo(
+        f"{result['lines']} lines ({result['rows']} unique, {result['lemmas']} "
+        + f"lemmas): {result['cards']} cards, "
+        + f"{result['rows_per_second']:.0f} rows/s"
+        + (
+            f", peak {result['peak_memory_mb']:.1f}MB"
+            if result["peak_memory_mb"] is not None
+            else ""
+        )
+    )
+    click.echo(
+        "    " + ", ".join(f"{stage} {took:.3f}s" for stage, took in seconds.items())
+    )
+
+
+@click.command()
+@click.option(
+    "--sizes",
+    default="100,1000,10000,100000",
+    help="Comma-separated numbers of vocab lines to benchmark",
+)
+@click.option(
+    "--word-settings",
+    type=click.Path(exists=True),
+    default="../settings/language_configs/russian.yaml",
+    help="Language config used to turn entries into cards",
+)
+@click.option(
+    "--sample",
+    type=click.Path(exists=True),
+    help="Kaikki JSONL sample to use instead of generated entries",
+)
+@click.option("--dictionary-size", default=20000, help="Words to generate entries for")
+@click.option("--anki-latency", default=5.0, help="Milliseconds per AnkiConnect call")
+@click.option("--anki-batch-size", default=utils.ANKI_WRITE_BATCH_SIZE)
+@click.option("--spacy-model", help="Use a real SpaCy model instead of splitting")
+@click.option("--write/--no-write", default=True, help="Benchmark writing to Anki")
+@click.option(
+    "--audio-cache",
+    is_flag=True,
+    help="Download audio through an audio cache (from a fake file server) when "
+    + "writing to Anki",
+)
+@click.option("--audio-latency", default=20.0, help="Milliseconds to download audio")
+@click.option(
+    "--forms",
+    is_flag=True,
+    help="Make some vocab words inflected forms, and resolve them with a forms "
+    + "collection",
+)
+@click.option("--memory/--no-memory", default=True, help="Measure peak memory")
+@click.option("--seed", default=0)
+@click.option("--output", type=click.Path(), help="Also save the results as JSON")
+def main(
+    sizes: str,
+    word_settings: click.Path,
+    sample: click.Path,
+    dictionary_size: int,
+    anki_latency: float,
+    anki_batch_size: int,
+    spacy_model: str,
+    write: bool,
+    audio_cache: bool,
+    audio_latency: float,
+    forms: bool,
+    memory: bool,
+    seed: int,
+    output: click.Path,
+):
+    # Time card generation against offline stand-ins for Mongo, AnkiConnect
+    # (on its usual port, so Anki needs to be closed) and DeepL
+    rng = random.Random(seed)
+
+    with open(word_settings) as f:
+        language_config = yaml.safe_load(f)
+
+    if sample:
+        entries = load_sample(sample)
+        words = sorted({entry["word"] for entry in entries})
+    else:
+        words = make_words(dictionary_size, rng)
+        entries = make_entries(words, rng)
+
+    if spacy_model:
+        import spacy
+
+        nlp = spacy.load(spacy_model)
+    else:
+        nlp = FakeNLP()
+
+    fake = FakeAnki(anki_latency / 1000, audio_latency / 1000)
+    server = serve_anki(fake)
+
+    cache = None
+    if audio_cache:
+        audio_server = serve_audio(latency=audio_latency / 1000)
+        cache = utils.AudioCache(
+            tempfile.mkdtemp(prefix="ankifier_audio_"), local_fetcher(audio_server)
+        )
+
+    context = utils.GenerationContext(
+        language_config, nlp, utils.TestTranslator(), FakeCollection(entries), DECK
+    )
+
+    form_docs = None
+    if forms:
+        form_docs = make_forms(entries)
+        context.forms_coll = FakeCollection(form_docs, "forms", key="form")
+
+    results = []
+    for size in [int(size) for size in sizes.split(",")]:
+        lines = "\n".join(make_vocab(size, words, rng, forms=form_docs)) + "\n"
+        result = run_size(lines, context, fake, anki_batch_size, write, memory, cache)
+        print_result(result)
+        results.append(result)
+
+    server.shutdown()
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
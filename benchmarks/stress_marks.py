@@ -0,0 +1,70 @@
+import click
+import random
+import sys
+import timeit
+
+import pandas as pd
+
+sys.path.append("..")
+
+from ankifier.utils import strip_stress_marks, strip_stress_marks_all
+from fakes import make_words, stressed
+
+
+def strip_stress_marks_bytes(text: str) -> str:
+    # The original implementation, for comparison
+    b = text.encode("utf-8")
+    b = b.replace(b"\xc3\xb3", b"\xd0\xbe")
+    b = b.replace(b"\xc3\xa1", b"\xd0\xb0")
+    b = b.replace(b"\xc3\xa0", b"\xd0\xb5")
+    b = b.replace(b"\xc3\xbd", b"\xd1\x83")
+    b = b.replace(b"\xcc\x81", b"").decode()
+    return b
+
+
+def make_texts(size, rng):
+    # Mostly stressed words and phrases, with some Latin look-alike vowels
+    words = make_words(2000, rng)
+    texts = []
+    for _ in range(size):
+        chosen = rng.choices(words, k=rng.randint(1, 4))
+        text = " ".join(stressed(word, rng) for word in chosen)
+        if rng.random() < 0.1:
+            text = text.replace("о", "ó", 1).replace("а", "á", 1)
+        texts.append(text)
+    return texts
+
+
+@click.command()
+@click.option("--size", default=1_000_000, help="Number of strings to normalise")
+@click.option("--repeat", default=3, help="Runs of each, the fastest is reported")
+@click.option("--seed", default=0)
+def main(size: int, repeat: int, seed: int):
+    # Compare the ways of stripping stress marks from a lot of text at once
+    texts = make_texts(size, random.Random(seed))
+    series = pd.Series(texts)
+
+    expected = [strip_stress_marks_bytes(text) for text in texts]
+    assert [strip_stress_marks(text) for text in texts] == expected
+    assert strip_stress_marks_all(texts) == expected
+    assert list(strip_stress_marks_all(series)) == expected
+
+    candidates = {
+        "bytes.replace, per string": lambda: [
+            strip_stress_marks_bytes(text) for text in texts
+        ],
+        "strip_stress_marks, per string": lambda: [
+            strip_stress_marks(text) for text in texts
+        ],
+        "strip_stress_marks_all, list": lambda: strip_stress_marks_all(texts),
+        "strip_stress_marks_all, Series": lambda: strip_stress_marks_all(series),
+        "Series.apply (old add_base)": lambda: series.apply(strip_stress_marks_bytes),
+    }
+
+    for name, fn in candidates.items():
+        took = min(timeit.repeat(fn, number=1, repeat=repeat))
+        click.echo(f"{name:35} {took:.3f}s ({size / took:,.0f} strings/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,27 @@
+import click
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pymongo import MongoClient
 
 sys.path.append("..")
 
-from ankifier.utils import call_ankiconnect, look_up_word, retrieve_fields
+from ankifier.utils import (
+    ANKI_NOTES_INFO_CHUNK,
+    CONCURRENCY_LIMITS,
+    AnkiConnect,
+    AudioCache,
+    look_up_words,
+    retrieve_fields,
+    store_media_action,
+)
 
 DECK_NAME = "Languages::Russian"
+# Any recording will do, not just the ones labelled "Audio"
+SOUND_FILTER = ".sounds[] | .mp3_url"
 
 
-def find_notes_without_audio(deck):
+def find_notes_without_audio(anki, deck):
     # Find all the notes that are not phrases and do not have audio
     query = f'deck:{deck} Audio: -"Part of speech:phrase"'
     request = {
@@ -16,68 +29,163 @@ def find_notes_without_audio(deck):
         "params": {"query": query},
         "version": 6,
     }
-    response = call_ankiconnect(request)
-    note_ids = response["result"]
-
-    # Get the actual *contents* of those notes
-    request = {
-        "action": "notesInfo",
-        "params": {"notes": note_ids},
-        "version": 6,
-    }
-    response = call_ankiconnect(request)
-    notes = response["result"]
-
+    return anki.call(request)["result"] or []
+
+
+def get_notes_info(anki, note_ids):
+    # Get the actual *contents* of those notes, a page at a time so we don't
+    # ask Anki for thousands of notes in one response
+    notes = []
+    for i in range(0, len(note_ids), ANKI_NOTES_INFO_CHUNK):
+        request = {
+            "action": "notesInfo",
+            "params": {"notes": note_ids[i : i + ANKI_NOTES_INFO_CHUNK]},
+            "version": 6,
+        }
+        notes.extend(anki.call(request)["result"] or [])
     return notes
 
 
-def get_audio_url_for_base(base_form, coll):
-    entries = look_up_word(coll, base_form)
-    for entry in entries:
-        audio = retrieve_fields(entry, ".sounds[] | .mp3_url")
-        if audio:
-            # Pull just the first sound entry
-            return audio[0]
-    return
-
-
-def add_audio_to_note(note, coll):
-    note_id = note["noteId"]
-    base_form = note["fields"]["Base form"]["value"]
-    url = get_audio_url_for_base(base_form, coll)
-    print("Audio link: ", url)
-
-    if not url:
-        # Don't do anything if we don't find a url
-        return
+def get_audio_urls(coll, base_forms, workers):
+    # Look up every base form at once, returning the first recording for each
+    with ThreadPoolExecutor(workers) as executor:
+        entries_by_word = look_up_words(coll, base_forms, executor=executor)
+
+    urls = {}
+    for base_form, entries in entries_by_word.items():
+        for entry in entries:
+            audio = retrieve_fields(entry, SOUND_FILTER)
+            if audio:
+                # Pull just the first sound entry
+                urls[base_form] = audio[0]
+                break
+    return urls
+
+
+def build_update(note_id, base_form, url, path=None):
+    if path is not None:
+        # Already downloaded to the audio cache, so just point at the file
+        note = {
+            "id": note_id,
+            "fields": {"Audio": f"[sound:{os.path.basename(path)}]"},
+        }
+    else:
+        note = {
+            "id": note_id,
+            # Need a dummy "fields" method or the call fails
+            "fields": {},
+            "audio": [
+                {"url": url, "filename": f"{base_form}.mp3", "fields": ["Audio"]}
+            ],
+        }
+    return {"action": "updateNote", "params": {"note": note}}
+
+
+def read_done(resume_file):
+    if not os.path.exists(resume_file):
+        return set()
+    with open(resume_file) as f:
+        return {int(line) for line in f if line.strip()}
+
+
+@click.command()
+@click.option("--deck", default=DECK_NAME, help="Anki deck to add audio to")
+@click.option("--database", default="ankifier", help="Mongo database for Ankifier")
+@click.option("--collection", default="ru_wiktionary", help="Wiktionary collection")
+@click.option("--batch-size", default=20, help="Notes to update per request")
+@click.option("--workers", default=4, help="AnkiConnect requests to run at once")
+@click.option(
+    "--resume-file",
+    type=click.Path(dir_okay=False),
+    default="add_audio.done",
+    help="Records updated notes so an interrupted run can carry on",
+)
+@click.option(
+    "--audio-cache-dir",
+    type=click.Path(file_okay=False),
+    help="Download the audio here first, rather than having Anki fetch it",
+)
+@click.option("--dry-run", is_flag=True, help="Show what would be updated")
+def main(
+    deck: str,
+    database: str,
+    collection: str,
+    batch_size: int,
+    workers: int,
+    resume_file: click.Path,
+    audio_cache_dir: click.Path,
+    dry_run: bool,
+):
+    # Each update makes Anki download the mp3 before responding, so requests
+    # are sent from a few threads at once, sharing the client's connections
+    anki = AnkiConnect(pool_size=workers)
+    note_ids = find_notes_without_audio(anki, deck)
+    done = read_done(resume_file)
+    note_ids = [note_id for note_id in note_ids if note_id not in done]
+    notes = get_notes_info(anki, note_ids)
+    print(f"Found {len(notes)} notes to process ({len(done)} done on earlier runs)")
 
-    request = {
-        "action": "updateNote",
-        "version": 6,
-        "params": {
-            "note": {
-                "id": note_id,
-                # Need a dummy "fields" method or the call fails
-                "fields": {},
-                "audio": [
-                    {"url": url, "filename": f"{base_form}.mp3", "fields": ["Audio"]}
-                ],
-            }
-        },
-    }
-
-    call_ankiconnect(request)
-
-
-def main():
-    notes_to_process = find_notes_without_audio(DECK_NAME)
-    print(f"Found {len(notes_to_process)} notes to process")
     mongo_client = MongoClient(serverSelectionTimeoutMS=1000)
-    coll = mongo_client["ankifier"]["ru_wiktionary"]
+    coll = mongo_client[database][collection]
+    base_forms = {
+        note["noteId"]: note["fields"]["Base form"]["value"] for note in notes
+    }
+    urls = get_audio_urls(coll, base_forms.values(), CONCURRENCY_LIMITS["mongo"])
+
+    updates = [
+        (note_id, base_form, urls[base_form])
+        for note_id, base_form in base_forms.items()
+        if base_form in urls
+    ]
+    print(f"Found audio for {len(updates)} notes")
+
+    if dry_run:
+        for note_id, base_form, url in updates:
+            print(f"Would add {url} to {base_form} ({note_id})")
+        anki.close()
+        return
 
-    for note in notes_to_process:
-        print("Adding audio to note: ", note["fields"]["Base form"]["value"])
-        add_audio_to_note(note, coll)
+    paths = {}
+    if audio_cache_dir:
+        # Download everything in parallel up front, so Anki only has to copy
+        # files from disk
+        paths = AudioCache(audio_cache_dir).prefetch(url for _, _, url in updates)
+
+    def send_batch(batch):
+        batch_paths = [paths.get(url) for _, _, url in batch]
+        media = [store_media_action(path) for path in set(batch_paths) if path]
+        actions = media + [
+            build_update(*update, path) for update, path in zip(batch, batch_paths)
+        ]
+        # Skip the results of storing the media, errors there will show up as
+        # missing audio rather than failed updates
+        return batch, anki.multi(actions)[len(media) :]
+
+    updated = 0
+    failed = 0
+    batches = [updates[i : i + batch_size] for i in range(0, len(updates), batch_size)]
+
+    with ThreadPoolExecutor(workers) as executor, open(resume_file, "a") as resume:
+        futures = [executor.submit(send_batch, batch) for batch in batches]
+        for future in as_completed(futures):
+            batch, results = future.result()
+            for (note_id, base_form, _), result in zip(batch, results):
+                if result["error"]:
+                    print(f"Error adding audio to {base_form}: {result['error']}")
+                    failed += 1
+                else:
+                    resume.write(f"{note_id}\n")
+                    updated += 1
+            resume.flush()
+            print(f"Updated {updated} of {len(updates)} notes", end="\r")
+
+    anki.close()
+
+    print(f"\nAdded audio to {updated} notes, {failed} failed")
+
+    # Finished, so the next run should look at every note again
+    if not failed and os.path.exists(resume_file):
+        os.remove(resume_file)
 
 
 if __name__ == "__main__":
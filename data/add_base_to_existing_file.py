@@ -4,17 +4,15 @@ import pandas as pd
 
 sys.path.append("..")
 
-from ankifier.utils import strip_stress_marks
+from ankifier.utils import strip_stress_marks_all
 
 
-def get_base_entry(row):
-    output = "" 
-    if row["Part-of-speech"] == "phrase":
-        output = row["Front"]
-    else:
-        output = row["Front"].split(",")[0]
+def get_base_entries(df):
+    # Phrases are their own base form; for words it's the first form on the front
+    first_forms = df["Front"].str.split(",").str[0]
+    output = first_forms.where(df["Part-of-speech"] != "phrase", df["Front"])
 
-    return strip_stress_marks(output) 
+    return strip_stress_marks_all(output)
 
 
 @click.command()
@@ -22,7 +20,7 @@ def get_base_entry(row):
 @click.option("--dest", type=click.Path())
 def main(file: click.Path, dest: click.Path):
     df = pd.read_csv(file)
-    df["Base"] = df.apply(get_base_entry, axis=1)
+    df["Base"] = get_base_entries(df)
 
     df.to_csv(dest, index=False)
 
@@ -0,0 +1,35 @@
+import click
+import sys
+import yaml
+from pymongo import MongoClient
+
+sys.path.append("..")
+
+from ankifier.utils import build_forms_collection
+
+
+@click.command()
+@click.option("--settings", type=click.Path(exists=True), required=True)
+@click.option("--language", required=True)
+@click.option("--dest", help="Collection to write to, defaults to forms_collection")
+def main(settings: click.Path, language: str, dest: str):
+    with open(settings) as f:
+        config = yaml.safe_load(f)
+    language_settings = config["language_configs"][language]
+
+    dest = dest or language_settings.get("forms_collection")
+    if not dest:
+        raise click.UsageError("Pass --dest or set forms_collection in the settings")
+
+    mongo_client = MongoClient(serverSelectionTimeoutMS=1000)
+    db = mongo_client[config["ankifier_config"]["mongodb_name"]]
+
+    # Built from the full collection, since the slim one has no form_of entries
+    count = build_forms_collection(
+        db[language_settings["wiktionary_collection"]], db[dest]
+    )
+    print(f"Wrote {count} forms to {dest}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import click
+import sys
+import yaml
+from pymongo import MongoClient
+
+sys.path.append("..")
+
+from ankifier.utils import build_slim_collection
+
+
+@click.command()
+@click.option("--settings", type=click.Path(exists=True), required=True)
+@click.option("--language", required=True)
+@click.option("--dest", help="Collection to write to, defaults to slim_collection")
+def main(settings: click.Path, language: str, dest: str):
+    with open(settings) as f:
+        config = yaml.safe_load(f)
+    language_settings = config["language_configs"][language]
+
+    with open(language_settings["word_settings"]) as f:
+        language_config = yaml.safe_load(f)
+
+    dest = dest or language_settings.get("slim_collection")
+    if not dest:
+        raise click.UsageError("Pass --dest or set slim_collection in the settings")
+
+    mongo_client = MongoClient(serverSelectionTimeoutMS=1000)
+    db = mongo_client[config["ankifier_config"]["mongodb_name"]]
+
+    count = build_slim_collection(
+        db[language_settings["wiktionary_collection"]], db[dest], language_config
+    )
+    print(f"Wrote {count} entries to {dest}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+import click
+import sys
+from pymongo import MongoClient
+
+sys.path.append("..")
+
+from ankifier.utils import ensure_indexes, uses_word_index
+
+
+@click.command()
+@click.option("--database", default="ankifier", help="Mongo database for Ankifier")
+@click.option("--collection", required=True, help="Collection for this language")
+def main(database: str, collection: str):
+    mongo_client = MongoClient(serverSelectionTimeoutMS=1000)
+    coll = mongo_client[database][collection]
+
+    ensure_indexes(coll)
+
+    if uses_word_index(coll):
+        print(f"Lookups on {database}.{collection} use an index")
+    else:
+        print(f"Warning: lookups on {database}.{collection} still scan the collection")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
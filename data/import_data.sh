@@ -5,4 +5,8 @@ DATABASE=$1 # MongoDB database you're using for Ankifier
 COLLECTION=$2 # Collection for this language
 FILEPATH=$3 # Path to Kaikki export
 
-mongoimport -d $DATABASE -c $COLLECTION --file $FILEPATH
\ No newline at end of file
+mongoimport -d $DATABASE -c $COLLECTION --file $FILEPATH
+
+# Index the collection so word lookups don't scan the whole export
+cd "$(dirname "$0")"
+python create_indexes.py --database $DATABASE --collection $COLLECTION
@@ -0,0 +1,167 @@
+import click
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+
+sys.path.append("..")
+
+from ankifier.utils import ensure_indexes, strip_stress_marks_all
+
+# Mongo error code for inserting a document whose _id already exists
+DUPLICATE_KEY_ERROR = 11000
+
+
+def read_batches(path, start, batch_size):
+    # Stream the file from the given byte offset, yielding batches of raw lines
+    # along with the offset each line starts at and where the batch ends
+    with open(path, "rb") as f:
+        f.seek(start)
+        offset = start
+        lines = []
+        for line in f:
+            lines.append((offset, line))
+            offset += len(line)
+            if len(lines) >= batch_size:
+                yield lines, offset
+                lines = []
+        if lines:
+            yield lines, offset
+
+
+def parse_batch(batch):
+    lines, end = batch
+    entries = []
+    for offset, line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        entry = json.loads(line)
+        # Use the line's position in the file as the id, so lines that get
+        # imported again after resuming don't end up in the collection twice
+        entry["_id"] = offset
+        entries.append(entry)
+
+    # Strip stress marks from the whole batch's words in one go
+    with_words = [entry for entry in entries if "word" in entry]
+    words = strip_stress_marks_all([entry["word"] for entry in with_words])
+    for entry, word in zip(with_words, words):
+        entry["word"] = word
+    return entries, end
+
+
+def insert_batch(coll, entries):
+    if not entries:
+        return 0
+    try:
+        return len(coll.insert_many(entries, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        # Entries we'd already written before being interrupted are fine, but
+        # don't count them again
+        errors = e.details["writeErrors"]
+        if any(err["code"] != DUPLICATE_KEY_ERROR for err in errors):
+            raise
+        return e.details["nInserted"]
+
+
+def read_checkpoint(checkpoint):
+    if os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            return int(f.read().strip() or 0)
+    return 0
+
+
+def write_checkpoint(checkpoint, offset):
+    # Write then rename, so an interruption can't leave a half-written file
+    with open(checkpoint + ".tmp", "w") as f:
+        f.write(str(offset))
+    os.replace(checkpoint + ".tmp", checkpoint)
+
+
+@click.command()
+@click.option("--database", default="ankifier", help="Mongo database for Ankifier")
+@click.option("--collection", required=True, help="Collection for this language")
+@click.option("--file", type=click.Path(exists=True), required=True)
+@click.option("--batch-size", default=1000, help="Entries per insert")
+@click.option("--workers", default=os.cpu_count(), help="Processes parsing JSON")
+@click.option("--writers", default=4, help="Parallel connections writing to Mongo")
+@click.option("--checkpoint", type=click.Path(), help="Defaults to <file>.checkpoint")
+@click.option(
+    "--drop",
+    is_flag=True,
+    help=(
+        "Drop the collection before a fresh import. Entries are deduplicated "
+        "by their position in the file, so use this when importing into a "
+        "collection first loaded with mongoimport, whose entries have "
+        "ObjectId ids and would otherwise be imported twice"
+    ),
+)
+def main(
+    database: str,
+    collection: str,
+    file: click.Path,
+    batch_size: int,
+    workers: int,
+    writers: int,
+    checkpoint: click.Path,
+    drop: bool,
+):
+    checkpoint = checkpoint or f"{file}.checkpoint"
+    start = read_checkpoint(checkpoint)
+    file_size = os.path.getsize(file)
+
+    mongo_client = MongoClient(serverSelectionTimeoutMS=1000, maxPoolSize=writers)
+    coll = mongo_client[database][collection]
+
+    if start:
+        print(f"Resuming from byte {start} of {file_size}")
+    elif drop:
+        coll.drop()
+
+    # Keep a bounded number of batches in flight at each step so memory use
+    # doesn't depend on the size of the file
+    max_in_flight = 2 * max(workers, writers)
+    parsing = deque()
+    writing = deque()
+    count = 0
+
+    def finish_oldest_write():
+        nonlocal count
+        future, end = writing.popleft()
+        count += future.result()
+        # Everything up to here has been written, so it's safe to resume from
+        write_checkpoint(checkpoint, end)
+        print(f"Imported {count} entries ({end / file_size:.1%})", end="\r")
+
+    def start_write(parsed):
+        entries, end = parsed
+        writing.append((write_pool.submit(insert_batch, coll, entries), end))
+        while writing and (len(writing) >= max_in_flight or writing[0][0].done()):
+            finish_oldest_write()
+
+    with ProcessPoolExecutor(workers) as parse_pool, ThreadPoolExecutor(
+        writers
+    ) as write_pool:
+        for batch in read_batches(file, start, batch_size):
+            parsing.append(parse_pool.submit(parse_batch, batch))
+            if len(parsing) >= max_in_flight:
+                start_write(parsing.popleft().result())
+
+        while parsing:
+            start_write(parsing.popleft().result())
+        while writing:
+            finish_oldest_write()
+
+    print(f"\nImported {count} entries into {database}.{collection}")
+    ensure_indexes(coll)
+
+    # Finished, so the next run should start from the beginning
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+
+if __name__ == "__main__":
+    main()